@@ -0,0 +1,166 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import spsuite.utils as utils
+from spsuite.tools import makedirs, printrecords, rendertpl
+
+phpversions = ['7.3', '7.4', '8.0']
+
+class FakeMySQL:
+    def __init__(self):
+        self.dbs = {}
+        self.users = ['root', 'sp-admin', 'debian-sys-maint']
+
+    def query(self, sql, params=None):
+        if 'information_schema.SCHEMATA' in sql:
+            return [(name, tables, tables * 16384) for name, tables in sorted(self.dbs.items())]
+        if 'SHOW DATABASES' in sql:
+            return [(name,) for name in sorted(self.dbs)]
+        if 'mysql.user' in sql:
+            return [(user,) for user in self.users]
+        return []
+
+    def execute(self, sql, params=None):
+        return 1
+
+    def executemany(self, statements):
+        pass
+
+class BenchServerPilot(utils.ServerPilot):
+    # Everything that would touch the real system is simulated.
+    def createdirs(self, paths):
+        created = []
+        for path in paths:
+            created.extend(makedirs(path))
+        return created
+
+    def chownpaths(self, paths, recursive=False, workers=1):
+        pass
+
+    async def aruncmds(self, cmds):
+        pass
+
+def stubsystem(mysql):
+    noop = lambda *args, **kwargs: None
+    utils.runcmd = noop
+    utils.testconfig = noop
+    utils.reloadservice = noop
+    utils.restartservice = noop
+    utils.userexists = lambda username: True
+    utils.sqlquery = mysql.query
+    utils.sqlexec = mysql.execute
+    utils.sqlexecmany = mysql.executemany
+
+def buildroot(root, apps, appsperuser, dbs):
+    for php in phpversions:
+        os.makedirs(os.path.join(root, 'etc', 'php{}-sp'.format(php), 'fpm-pools.d'))
+    for path in [('etc', 'nginx-sp', 'vhosts.d'), ('etc', 'nginx-sp', 'http.d'), ('etc', 'apache-sp', 'vhosts.d'), ('srv', '.meta')]:
+        os.makedirs(os.path.join(root, *path))
+    metadir = os.path.join(root, 'srv', '.meta')
+    for i in range(apps):
+        app = 'app{}'.format(i)
+        user = 'user{}'.format(i // appsperuser)
+        public = os.path.join(root, 'srv', 'users', user, 'apps', app, 'public')
+        os.makedirs(public)
+        with open(os.path.join(public, 'index.php'), 'w') as index:
+            index.write('<?php phpinfo();?>')
+        with open(os.path.join(metadir, '{}.json'.format(app)), 'w') as meta:
+            json.dump({'name': app, 'user': user, 'php': phpversions[i % 2], 'domains': ['{}.example.com'.format(app), 'www.{}.example.com'.format(app)]}, meta)
+    for i in range(dbs):
+        with open(os.path.join(metadir, 'dbmetainfo-db{}.json'.format(i)), 'w') as meta:
+            json.dump({'name': 'db{}'.format(i), 'user': 'dbuser{}'.format(i)}, meta)
+
+def timeit(results, apps, operation, func, count=1):
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull):
+            func()
+    elapsed = time.perf_counter() - start
+    results.append({
+        'apps': apps,
+        'operation': operation,
+        'seconds': round(elapsed, 6),
+        'per_item_ms': round(elapsed * 1000 / max(count, 1), 4)
+    })
+    print('{:>6} apps  {:<28} {:>10.2f} ms'.format(apps, operation, elapsed * 1000))
+
+def runsize(apps, args):
+    results = []
+    root = tempfile.mkdtemp(prefix='spsuite-bench-')
+    try:
+        mysql = FakeMySQL()
+        mysql.dbs = {'db{}'.format(i): i % 40 for i in range(args.dbs)}
+        stubsystem(mysql)
+        buildroot(root, apps, args.appsperuser, args.dbs)
+        sp = BenchServerPilot(mainroot=root)
+
+        timeit(results, apps, 'registry rebuild', sp.registry, apps)
+        timeit(results, apps, 'findapps (no size)', lambda: sp.findapps(size=False), apps)
+        sp.sizettl = 0
+        timeit(results, apps, 'findapps (cold size)', lambda: sp.findapps(size=True), apps)
+        sp.sizettl = 3600
+        timeit(results, apps, 'findapps (cached size)', lambda: sp.findapps(size=True), apps)
+        timeit(results, apps, 'listapps table', lambda: sp.listapps(size=False), apps)
+        timeit(results, apps, 'listapps ndjson', lambda: sp.listapps(size=False, fmt='ndjson'), apps)
+        timeit(results, apps, 'listdbs', lambda: printrecords(sp.dbinventory(), [('name', 'DB Name', None), ('user', 'User', None), ('size', 'Size', None)]), args.dbs)
+
+        renders = min(apps, args.renders)
+        tplsp = sp.spawn('app0')
+        tplsp.username = 'user0'
+        tplsp.domains = ['app0.example.com', 'www.app0.example.com']
+        timeit(results, apps, 'render templates', lambda: [rendertpl(tpl, tplsp.gettpldata()) for i in range(renders) for tpl in ['nginx.tpl', 'apache.tpl', 'fpm.tpl']], renders * 3)
+
+        creates = min(apps, args.creates)
+
+        def createapps():
+            for i in range(creates):
+                new = sp.spawn('new{}'.format(i))
+                new.username = 'newuser{}'.format(i // args.appsperuser)
+                new.domains = ['new{}.example.com'.format(i)]
+                new.createapp()
+
+        timeit(results, apps, 'createapp', createapps, creates)
+        sp.php = phpversions[2]
+        timeit(results, apps, 'changephpall', sp.changephpall, apps + creates)
+        timeit(results, apps, 'deleteallapps', sp.deleteallapps, apps + creates)
+        sp.registry().close()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return results
+
+def main():
+    ap = argparse.ArgumentParser(description='Time spsuite operations against a simulated ServerPilot filesystem.')
+    ap.add_argument('--sizes', dest='sizes', help='Comma separated app counts to benchmark (Default: 10,1000,10000).', default='10,1000,10000')
+    ap.add_argument('--apps-per-user', dest='appsperuser', help='Apps owned by each synthetic SSH user (Default: 25).', type=int, default=25)
+    ap.add_argument('--dbs', dest='dbs', help='Number of synthetic databases (Default: 100).', type=int, default=100)
+    ap.add_argument('--creates', dest='creates', help='Maximum number of apps created per size (Default: 100).', type=int, default=100)
+    ap.add_argument('--renders', dest='renders', help='Maximum number of template render rounds per size (Default: 1000).', type=int, default=1000)
+    ap.add_argument('--output', dest='output', help='Write the results as JSON to this file.', default=None)
+    args = ap.parse_args()
+
+    results = []
+    for size in [int(size) for size in args.sizes.split(',')]:
+        results.extend(runsize(size, args))
+
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump({
+                'timestamp': int(time.time()),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'results': results
+            }, out, indent=2)
+
+if __name__ == '__main__':
+    main()
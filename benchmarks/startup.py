@@ -0,0 +1,52 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+def timecommand(argv, runs):
+    timings = []
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for i in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + argv, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return {
+        'command': ' '.join(argv),
+        'runs': runs,
+        'min_ms': round(timings[0], 2),
+        'median_ms': round(timings[len(timings) // 2], 2),
+        'max_ms': round(timings[-1], 2)
+    }
+
+def main():
+    ap = argparse.ArgumentParser(description='Measure spsuite CLI startup time.')
+    ap.add_argument('--runs', dest='runs', help='Number of invocations per command (Default: 20).', type=int, default=20)
+    ap.add_argument('--max-ms', dest='maxms', help='Fail if the median startup time of any command exceeds this many milliseconds.', type=float, default=None)
+    ap.add_argument('--output', dest='output', help='Write the results as JSON to this file.', default=None)
+    args = ap.parse_args()
+
+    results = [timecommand(['-c', 'pass'], args.runs)]
+    for command in [['listsysusers'], ['-h']]:
+        results.append(timecommand(['-m', 'spsuite'] + command, args.runs))
+
+    for result in results:
+        print('{:<24} min {:>8.2f} ms   median {:>8.2f} ms   max {:>8.2f} ms'.format(result['command'], result['min_ms'], result['median_ms'], result['max_ms']))
+
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(results, out, indent=2)
+
+    if args.maxms is not None:
+        for result in results[1:]:
+            if result['median_ms'] > args.maxms:
+                print('Startup regression: {} took {} ms (limit {} ms).'.format(result['command'], result['median_ms'], args.maxms))
+                sys.exit(1)
+
+if __name__ == '__main__':
+    main()
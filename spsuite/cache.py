@@ -0,0 +1,73 @@
+import os
+import re
+import hashlib
+from urllib.parse import urlsplit
+
+# Must match proxy_cache_key in nginx-cache.tpl.
+keyformat = '{scheme}{host}{uri}'
+
+def validttl(ttl):
+    return re.match(r'^\d+[smh]?$', str(ttl)) is not None
+
+def validsize(size):
+    return re.match(r'^\d+[kmg]?$', str(size).lower()) is not None
+
+def cachekeys(target, domains):
+    # A full URL names one cache key per scheme it was given with; a bare path
+    # is looked up on every domain of the app, over HTTP and HTTPS.
+    parts = urlsplit(target)
+    uri = parts.path or '/'
+    if parts.query:
+        uri += '?' + parts.query
+    if parts.scheme and parts.netloc:
+        return [keyformat.format(scheme=parts.scheme.lower(), host=parts.hostname.lower(), uri=uri)]
+    return [keyformat.format(scheme=scheme, host=domain.lower(), uri=uri) for domain in domains for scheme in ['http', 'https']]
+
+def cachefile(cachedir, key):
+    # levels=1:2 stores a key's md5 under <last char>/<two chars before it>/.
+    digest = hashlib.md5(key.encode('utf-8')).hexdigest()
+    return os.path.join(cachedir, digest[-1], digest[-3:-1], digest)
+
+def storedkey(path):
+    try:
+        with open(path, 'rb') as cached:
+            header = cached.read(8192)
+    except OSError:
+        return None
+    start = header.find(b'\nKEY: ')
+    if start < 0:
+        return None
+    end = header.find(b'\n', start + 6)
+    if end < 0:
+        return None
+    return header[start + 6:end].decode('utf-8', 'replace')
+
+def cachedfiles(cachedir):
+    for dirpath, dirnames, filenames in os.walk(cachedir):
+        for filename in filenames:
+            # Files with a dot are still being written by nginx.
+            if '.' not in filename:
+                yield os.path.join(dirpath, filename)
+
+def removefile(path):
+    try:
+        os.unlink(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+def purgekeys(cachedir, keys):
+    return len([key for key in keys if removefile(cachefile(cachedir, key))])
+
+def purgeprefixes(cachedir, prefixes):
+    # Keys are hashed in the file names, so a prefix has to be matched against
+    # the KEY line nginx writes into every cache file.
+    purged = 0
+    for path in cachedfiles(cachedir):
+        key = storedkey(path)
+        if key is not None and key.startswith(tuple(prefixes)) and removefile(path):
+            purged += 1
+    return purged
+
+def purgeall(cachedir):
+    return len([path for path in cachedfiles(cachedir) if removefile(path)])
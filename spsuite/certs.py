@@ -0,0 +1,86 @@
+import os
+import time
+import uuid
+import threading
+from contextlib import contextmanager
+
+defaultacmeserver = 'https://acme-v02.api.letsencrypt.org/directory'
+
+# Let's Encrypt allows 300 new orders per account every 3 hours.
+acmelimits = {
+    defaultacmeserver: (300, 10800)
+}
+
+# Certbot holds an exclusive lock on its config dir, so issuance itself
+# cannot overlap within one --config-dir.
+certbotlock = threading.Lock()
+
+class RateLimiter:
+    def __init__(self, limit, period):
+        self.limit = limit
+        self.period = period
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.calls = [ts for ts in self.calls if now - ts < self.period]
+                if len(self.calls) < self.limit:
+                    self.calls.append(now)
+                    return
+                wait = self.period - (now - self.calls[0])
+            time.sleep(wait)
+
+limiters = {}
+limiterslock = threading.Lock()
+
+def getlimiter(server):
+    with limiterslock:
+        if server not in limiters:
+            limit, period = acmelimits.get(server, (300, 10800))
+            limiters[server] = RateLimiter(limit, period)
+        return limiters.get(server)
+
+@contextmanager
+def challengedir(webroot):
+    # Created once per app before its domains are checked in parallel, and
+    # removed again only after every check is done.
+    path = os.path.join(webroot, '.well-known', 'acme-challenge')
+    created = []
+    parent = path
+    while not os.path.exists(parent):
+        created.insert(0, parent)
+        parent = os.path.dirname(parent)
+    os.makedirs(path, 0o755, exist_ok=True)
+    try:
+        yield path
+    finally:
+        for dirpath in reversed(created):
+            try:
+                os.rmdir(dirpath)
+            except OSError:
+                pass
+
+def checkwebroot(domain, challengepath, timeout=10):
+    import ssl
+    import urllib.request
+    token = uuid.uuid4().hex
+    tokenfile = os.path.join(challengepath, token)
+    try:
+        with open(tokenfile, 'w') as tf:
+            tf.write(token)
+        os.chmod(tokenfile, 0o644)
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        url = 'http://{}/.well-known/acme-challenge/{}'.format(domain, token)
+        try:
+            with urllib.request.urlopen(url, timeout=timeout, context=context) as res:
+                return res.read(len(token) + 1).decode('utf-8', 'ignore').strip() == token
+        except Exception:
+            return False
+    finally:
+        if os.path.exists(tokenfile):
+            os.unlink(tokenfile)
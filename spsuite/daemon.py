@@ -0,0 +1,281 @@
+import os
+import json
+import time
+import types
+import queue
+import signal
+import socket
+import threading
+from contextlib import contextmanager
+from .utils import ServerPilot
+from .tools import futures, WriteBatch, defaultsocket
+from .watcher import Watcher
+
+statefields = ['username', 'app', 'php', 'domains', 'sizettl', 'sizeworkers', 'acmeserver']
+
+readmethods = ['iterapps', 'findapps', 'appnames', 'appdetails', 'whoisdomain', 'dbinventory', 'dbslist', 'dbuserslist', 'itersysusers', 'planmanifest', 'fpmstatus']
+
+writemethods = ['createuser', 'createapp', 'delapp', 'changephpversion', 'updatedomains', 'activatessl', 'removecert', 'forcessl', 'unforcessl', 'deleteallapps', 'changephpall', 'getcerts', 'regenconfigs', 'fixappperms', 'fixuserperms', 'createdb', 'dropdb', 'createsqluser', 'dropsqluser', 'allowunknown', 'denyunknown', 'rebuildregistry', 'applymanifest', 'tunefpm', 'enablecache', 'disablecache']
+
+# Bulk operations batch their own reloads and can run for minutes, so they are
+# not queued behind (or in front of) other clients' changes.
+bulkmethods = ['deleteallapps', 'changephpall', 'getcerts', 'regenconfigs', 'applymanifest', 'tunefpm', 'rebuildregistry']
+
+# Seconds a client waits for the daemon to answer a call.
+calltimeout = 120
+bulktimeout = 3600
+
+class MutationQueue:
+    def __init__(self, sp, window=0.02, workers=8, batches=4):
+        self.sp = sp
+        self.window = window
+        self.workers = workers
+        self.pending = queue.Queue()
+        self.running = threading.BoundedSemaphore(batches)
+        worker = threading.Thread(target=self.run, daemon=True)
+        worker.start()
+
+    def submit(self, func):
+        job = {'func': func, 'done': threading.Event(), 'result': None, 'error': None, 'services': set()}
+        self.pending.put(job)
+        job['done'].wait()
+        if job['error'] is not None:
+            raise job['error']
+        return job['result']
+
+    def run(self):
+        while True:
+            jobs = [self.pending.get()]
+            # Mutations arriving within the window share a single reload.
+            deadline = time.monotonic() + self.window
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    jobs.append(self.pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            # A slow batch (certbot) must not hold up the next one; batches
+            # only meet on the app and service locks.
+            self.running.acquire()
+            threading.Thread(target=self.runbatch, args=(jobs,), daemon=True).start()
+
+    def runbatch(self, jobs):
+        base = self.sp.spawn(False)
+        base.writebatch = WriteBatch()
+
+        def runjob(job):
+            # Each job tracks its own services, so a failed reload is only
+            # reported to the clients whose changes needed it.
+            sp = base.spawn(False)
+            sp.dirtyservices = job['services'] = set()
+            try:
+                job['result'] = job['func'](sp)
+            except Exception as e:
+                job['error'] = e
+
+        try:
+            try:
+                with futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+                    list(pool.map(runjob, jobs))
+            finally:
+                base.writebatch.commit()
+            failed = base.reloaddirty(set().union(*[job.get('services') for job in jobs]))
+            for job in jobs:
+                jobfailed = {service: failed.get(service) for service in job.get('services') if service in failed}
+                if job['error'] is None and len(jobfailed):
+                    job['error'] = base.reloaderror(jobfailed)
+        except Exception as e:
+            for job in jobs:
+                if job['error'] is None:
+                    job['error'] = e
+        finally:
+            self.running.release()
+        for job in jobs:
+            job['done'].set()
+
+class Daemon:
+    def __init__(self, sp, window=0.02, workers=8):
+        self.sp = sp
+        self.mutations = MutationQueue(sp, window=window, workers=workers)
+
+    def pilot(self, base, state):
+        sp = base.spawn(state.get('app'))
+        for field in statefields:
+            if field in state:
+                setattr(sp, field, state.get(field))
+        return sp
+
+    def call(self, sp, method, args, kwargs):
+        result = getattr(sp, method)(*args, **kwargs)
+        if isinstance(result, types.GeneratorType):
+            result = list(result)
+        return result
+
+    def handle(self, request, session):
+        method = request.get('method')
+        state = request.get('state') or {}
+        args = request.get('args') or []
+        kwargs = request.get('kwargs') or {}
+        if method == 'beginbatch':
+            if session.get('batch') is None:
+                base = self.sp.spawn(False)
+                base.dirtyservices = None
+                batch = base.batchreload()
+                batch.__enter__()
+                session.update({'base': base, 'batch': batch})
+            return None
+        if method == 'endbatch':
+            return self.endbatch(session)
+        if method in readmethods:
+            sp = self.pilot(self.sp, state)
+            sp.dirtyservices = None
+            return self.call(sp, method, args, kwargs)
+        if method in writemethods:
+            if session.get('batch') is not None:
+                return self.call(self.pilot(session.get('base'), state), method, args, kwargs)
+            if method in bulkmethods:
+                sp = self.pilot(self.sp, state)
+                sp.dirtyservices = None
+                with sp.batchreload():
+                    return self.call(sp, method, args, kwargs)
+            return self.mutations.submit(lambda base: self.call(self.pilot(base, state), method, args, kwargs))
+        raise Exception('Unknown method {}.'.format(method))
+
+    def endbatch(self, session):
+        batch = session.get('batch')
+        session.clear()
+        if batch is not None:
+            batch.__exit__(None, None, None)
+
+    def serveconnection(self, rfile, wfile):
+        session = {}
+        try:
+            for line in rfile:
+                try:
+                    response = {'result': self.handle(json.loads(line.decode('utf-8')), session), 'error': None}
+                except Exception as e:
+                    response = {'result': None, 'error': str(e)}
+                wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+                wfile.flush()
+        finally:
+            # A client that disconnects mid-batch still gets its services reloaded.
+            try:
+                self.endbatch(session)
+            except Exception:
+                pass
+
+def serve(path=defaultsocket, window=0.02, workers=8):
+    import socketserver
+
+    if os.path.exists(path):
+        remote = connect(path)
+        if remote is not None:
+            remote.close()
+            raise Exception('An spsuite daemon is already listening on {}.'.format(path))
+        os.unlink(path)
+
+    sp = ServerPilot()
+    sp.registry()
+    daemon = Daemon(sp, window=window, workers=workers)
+    watcher = Watcher(sp)
+    watcher.start()
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            daemon.serveconnection(self.rfile, self.wfile)
+
+    umask = os.umask(0o077)
+    try:
+        server = socketserver.ThreadingUnixStreamServer(path, Handler)
+    finally:
+        os.umask(umask)
+    server.daemon_threads = True
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    try:
+        server.serve_forever()
+    finally:
+        watcher.stop()
+        server.server_close()
+        if os.path.exists(path):
+            os.unlink(path)
+
+class RemoteServerPilot(ServerPilot):
+    def __init__(self, sock):
+        ServerPilot.__init__(self)
+        self.sock = sock
+        self.stream = sock.makefile('rwb')
+        self.streamlock = threading.Lock()
+        self.inbatch = False
+
+    def call(self, method, *args, **kwargs):
+        request = {
+            'method': method,
+            'args': args,
+            'kwargs': kwargs,
+            'state': {field: getattr(self, field) for field in statefields}
+        }
+        timeout = bulktimeout if method in bulkmethods else calltimeout
+        with self.streamlock:
+            if self.stream.closed:
+                raise Exception('The connection to the spsuite daemon has been closed.')
+            self.sock.settimeout(timeout)
+            try:
+                self.stream.write(json.dumps(request).encode('utf-8') + b'\n')
+                self.stream.flush()
+                line = self.stream.readline()
+            except socket.timeout:
+                # The reply may still come, so this connection cannot be reused.
+                self.close()
+                raise Exception('The spsuite daemon did not answer {} within {} seconds. It may still be applying the change, so check the result before retrying. Set SPSUITE_NO_DAEMON=1 to run commands without the daemon.'.format(method, timeout))
+        if not line:
+            raise Exception('The spsuite daemon closed the connection.')
+        response = json.loads(line.decode('utf-8'))
+        if response.get('error') is not None:
+            raise Exception(response.get('error'))
+        return response.get('result')
+
+    @contextmanager
+    def batchreload(self):
+        if self.inbatch:
+            yield
+            return
+        self.call('beginbatch')
+        self.inbatch = True
+        try:
+            yield
+        finally:
+            self.inbatch = False
+            self.call('endbatch')
+
+    def createsqluser(self, user, password=None):
+        if password is None:
+            password = self.askpassword()
+        return self.call('createsqluser', user, password=password)
+
+    def close(self):
+        self.stream.close()
+        self.sock.close()
+
+def remotemethod(name):
+    def method(self, *args, **kwargs):
+        return self.call(name, *args, **kwargs)
+    method.__name__ = name
+    return method
+
+for name in readmethods + writemethods:
+    if name not in RemoteServerPilot.__dict__:
+        setattr(RemoteServerPilot, name, remotemethod(name))
+
+def connect(path=defaultsocket):
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    return RemoteServerPilot(sock)
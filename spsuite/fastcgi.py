@@ -0,0 +1,81 @@
+import json
+import struct
+import asyncio
+
+FCGI_VERSION = 1
+FCGI_BEGIN_REQUEST = 1
+FCGI_END_REQUEST = 3
+FCGI_PARAMS = 4
+FCGI_STDIN = 5
+FCGI_STDOUT = 6
+FCGI_STDERR = 7
+FCGI_RESPONDER = 1
+
+header = struct.Struct('!BBHHBx')
+
+def record(rtype, content, requestid=1):
+    padding = -len(content) % 8
+    return header.pack(FCGI_VERSION, rtype, requestid, len(content), padding) + content + b'\0' * padding
+
+def encodelength(length):
+    if length < 128:
+        return struct.pack('!B', length)
+    return struct.pack('!I', length | 0x80000000)
+
+def encodeparams(params):
+    data = b''
+    for name, value in params.items():
+        name = name.encode('utf-8')
+        value = value.encode('utf-8')
+        data += encodelength(len(name)) + encodelength(len(value)) + name + value
+    return data
+
+async def request(socketpath, params, timeout=2):
+    reader, writer = await asyncio.wait_for(asyncio.open_unix_connection(socketpath), timeout)
+    try:
+        writer.write(record(FCGI_BEGIN_REQUEST, struct.pack('!HB5x', FCGI_RESPONDER, 0)))
+        writer.write(record(FCGI_PARAMS, encodeparams(params)))
+        writer.write(record(FCGI_PARAMS, b''))
+        writer.write(record(FCGI_STDIN, b''))
+        await writer.drain()
+        return await asyncio.wait_for(readresponse(reader), timeout)
+    finally:
+        writer.close()
+
+async def readresponse(reader):
+    stdout = b''
+    stderr = b''
+    while True:
+        version, rtype, requestid, length, padding = header.unpack(await reader.readexactly(header.size))
+        content = await reader.readexactly(length + padding)
+        content = content[:length]
+        if rtype == FCGI_STDOUT:
+            stdout += content
+        elif rtype == FCGI_STDERR:
+            stderr += content
+        elif rtype == FCGI_END_REQUEST:
+            break
+    headers, sep, body = stdout.partition(b'\r\n\r\n')
+    if not sep:
+        headers, body = b'', stdout
+    return headers.decode('latin-1'), body, stderr.decode('utf-8', 'ignore')
+
+async def fpmstatus(socketpath, path='/php-fpm-status', timeout=2):
+    params = {
+        'GATEWAY_INTERFACE': 'FastCGI/1.0',
+        'REQUEST_METHOD': 'GET',
+        'SCRIPT_NAME': path,
+        'SCRIPT_FILENAME': path,
+        'REQUEST_URI': '{}?json'.format(path),
+        'QUERY_STRING': 'json',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'REMOTE_ADDR': '127.0.0.1'
+    }
+    headers, body, stderr = await request(socketpath, params, timeout=timeout)
+    for line in headers.split('\r\n'):
+        if line.lower().startswith('status:') and not line.split(':', 1)[1].strip().startswith('200'):
+            raise Exception('The pool answered with {}.'.format(line.split(':', 1)[1].strip()))
+    try:
+        return json.loads(body.decode('utf-8', 'ignore'))
+    except ValueError:
+        raise Exception('The pool did not return a JSON status page.')
@@ -0,0 +1,62 @@
+import os
+
+# Memory assumed for a pool that has no running workers to measure.
+defaultworkermem = 48 * 1024 * 1024
+
+def meminfo(procdir='/proc'):
+    info = {}
+    with open(os.path.join(procdir, 'meminfo')) as meminfofile:
+        for line in meminfofile:
+            parts = line.split()
+            if len(parts) >= 2 and parts[1].isdigit():
+                info[parts[0].rstrip(':')] = int(parts[1]) * 1024
+    return info
+
+def procmemory(piddir):
+    # PSS splits shared pages (opcache, libraries) between workers, so it adds up
+    # to what the pool really costs. Older kernels only have VmRSS.
+    for filename, field in [('smaps_rollup', 'Pss:'), ('status', 'VmRSS:')]:
+        try:
+            with open(os.path.join(piddir, filename)) as memfile:
+                for line in memfile:
+                    if line.startswith(field):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            continue
+    return None
+
+def poolmemory(procdir='/proc'):
+    pools = {}
+    with os.scandir(procdir) as entries:
+        for entry in entries:
+            if not entry.name.isdigit():
+                continue
+            try:
+                with open(os.path.join(entry.path, 'cmdline'), 'rb') as cmdline:
+                    title = cmdline.read().replace(b'\0', b' ').decode('utf-8', 'ignore').strip()
+            except OSError:
+                continue
+            if not title.startswith('php-fpm: pool '):
+                continue
+            memory = procmemory(entry.path)
+            if memory:
+                pools.setdefault(title[len('php-fpm: pool '):].strip(), []).append(memory)
+    return pools
+
+def poolsettings(workermem, budget, workers):
+    maxchildren = max(2, min(int(budget // workermem), 100))
+    if workers >= 3:
+        # Busy pools keep warm workers around instead of forking per request.
+        startservers = max(2, min(workers, maxchildren // 2))
+        return {
+            'pm': 'dynamic',
+            'max_children': maxchildren,
+            'start_servers': startservers,
+            'min_spare_servers': max(1, startservers // 2),
+            'max_spare_servers': max(startservers, min(maxchildren, startservers * 2))
+        }
+    return {
+        'pm': 'ondemand',
+        'max_children': maxchildren,
+        'process_idle_timeout': '10s'
+    }
@@ -0,0 +1,48 @@
+import os
+import fcntl
+import threading
+from contextlib import contextmanager
+
+# flock() locks belong to an open file description, so every thread opens its
+# own descriptor and threads exclude each other just like processes do. A
+# thread that already holds a lock re-enters it instead of deadlocking.
+held = threading.local()
+
+def heldlocks():
+    if not hasattr(held, 'locks'):
+        held.locks = {}
+    return held.locks
+
+@contextmanager
+def lockfile(path, shared=False):
+    locks = heldlocks()
+    entry = locks.get(path)
+    if entry is not None:
+        fd, mode, depth = entry
+        if mode == fcntl.LOCK_SH and not shared:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            locks[path] = [fd, fcntl.LOCK_EX, depth + 1]
+        else:
+            entry[2] += 1
+        try:
+            yield
+        finally:
+            entry = locks.get(path)
+            entry[2] -= 1
+            if mode == fcntl.LOCK_SH and entry[1] == fcntl.LOCK_EX:
+                fcntl.flock(fd, fcntl.LOCK_SH)
+                entry[1] = fcntl.LOCK_SH
+        return
+
+    mode = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, mode)
+        locks[path] = [fd, mode, 1]
+        try:
+            yield
+        finally:
+            del locks[path]
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
@@ -0,0 +1,167 @@
+import os
+import re
+import mmap
+from collections import Counter
+from datetime import datetime
+
+chunksize = 64 * 1024 * 1024
+
+# URIs kept per chunk. Rarer URIs are dropped before chunks are merged, so
+# the top URIs of huge logs are approximate.
+uricapacity = 1000
+
+# log_format main from nginx-sp: $remote_addr - $remote_user [$time_local] "$request" $status $body_bytes_sent ...
+nginxline = re.compile(rb'^[^\[\n]*\[([^\]\n]+)\] "(?:[A-Z]+ )?([^ "?\n]*)[^"\n]*" (\d{3}) (\d+|-)', re.M)
+
+# access.format from fpm.tpl: ... [%t] "%m %r%Q%q" %s %l - %P %p %{seconds}d %{bytes}M %{user}C%% %{system}C%% ...
+phpline = re.compile(rb'^[^\[\n]*\[([^\]\n]+)\] "[^"\n]*" (\d{3}) \S+ - \S+ \S+ ([\d.]+) \d+ [\d.]+% [\d.]+%', re.M)
+
+def logtime(value):
+    try:
+        return datetime.strptime(value.decode('ascii', 'ignore'), '%d/%b/%Y:%H:%M:%S %z').timestamp()
+    except ValueError:
+        return None
+
+def accesslogs(logdir, app):
+    logs = [
+        ('nginx', os.path.join(logdir, '{}_nginx.access.log'.format(app))),
+        ('nginx', os.path.join(logdir, '{}_nginx.access_ssl.log'.format(app)))
+    ]
+    if os.path.isdir(logdir):
+        for name in sorted(os.listdir(logdir)):
+            # One access log per PHP version the app has used.
+            if name.startswith('{}_php'.format(app)) and name.endswith('.access.log'):
+                logs.append(('php', os.path.join(logdir, name)))
+    return [(kind, path) for kind, path in logs if os.path.isfile(path)]
+
+def completeend(path, start, size):
+    # Stop after the last complete line; a half-written line is read next time.
+    if size <= start:
+        return start
+    with open(path, 'rb') as logfile:
+        with mmap.mmap(logfile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return data.rfind(b'\n', start, size) + 1 or start
+
+def logsegments(path, inode, offset):
+    # Returns the new (inode, offset) to save and the (path, start, end) byte
+    # ranges that still have to be read.
+    stat = os.stat(path)
+    segments = []
+    if inode != stat.st_ino or stat.st_size < offset:
+        # Rotated or truncated. Finish the rotated file if it is still there.
+        rotated = '{}.1'.format(path)
+        if inode is not None and os.path.isfile(rotated) and os.stat(rotated).st_ino == inode:
+            size = os.stat(rotated).st_size
+            if size > offset:
+                segments.append((rotated, offset, completeend(rotated, offset, size)))
+        offset = 0
+    end = completeend(path, offset, stat.st_size)
+    if end > offset:
+        segments.append((path, offset, end))
+    return stat.st_ino, end, segments
+
+def chunks(segments, size=chunksize):
+    for path, start, end in segments:
+        while start < end:
+            yield path, start, min(start + size, end)
+            start += size
+
+def newstats():
+    return {
+        'requests': 0,
+        'bytes': 0,
+        'status': Counter(),
+        'uris': Counter(),
+        'phprequests': 0,
+        'durations': Counter(),
+        'first': None,
+        'last': None
+    }
+
+def linerange(data, start, stop):
+    # A chunk owns every line that starts inside it, even if the line runs past its end.
+    if start > 0 and data[start - 1] != 10:
+        start = data.find(b'\n', start, stop) + 1 or stop
+    if data[stop - 1] != 10:
+        stop = data.find(b'\n', stop) + 1 or len(data)
+    return start, stop
+
+def parsechunk(kind, path, start, stop):
+    stats = newstats()
+    with open(path, 'rb') as logfile:
+        with mmap.mmap(logfile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            start, stop = linerange(data, start, stop)
+            if start >= stop:
+                return stats
+            first = last = None
+            if kind == 'nginx':
+                status = stats.get('status')
+                uris = stats.get('uris')
+                sent = 0
+                for match in nginxline.finditer(data, start, stop):
+                    if first is None:
+                        first = match.group(1)
+                    last = match.group(1)
+                    status[match.group(3)[:1]] += 1
+                    uris[match.group(2)] += 1
+                    if match.group(4) != b'-':
+                        sent += int(match.group(4))
+                stats['requests'] = sum(status.values())
+                stats['bytes'] = sent
+                stats['uris'] = Counter(dict(uris.most_common(uricapacity)))
+            else:
+                durations = stats.get('durations')
+                for match in phpline.finditer(data, start, stop):
+                    if first is None:
+                        first = match.group(1)
+                    last = match.group(1)
+                    durations[int(float(match.group(3)) * 1000)] += 1
+                stats['phprequests'] = sum(durations.values())
+    if first is not None:
+        stats['first'] = logtime(first)
+        stats['last'] = logtime(last)
+    return stats
+
+def mergestats(total, part):
+    for key in ['requests', 'bytes', 'phprequests']:
+        total[key] += part.get(key)
+    for key in ['status', 'uris', 'durations']:
+        total[key].update(part.get(key))
+    # Only nginx lines count towards the period a request rate is taken over.
+    if part.get('requests') and part.get('first') is not None:
+        total['first'] = part.get('first') if total.get('first') is None else min(total.get('first'), part.get('first'))
+        total['last'] = part.get('last') if total.get('last') is None else max(total.get('last'), part.get('last'))
+    return total
+
+def percentile(durations, fraction):
+    count = sum(durations.values())
+    if not count:
+        return None
+    rank = fraction * count
+    seen = 0
+    for duration in sorted(durations):
+        seen += durations.get(duration)
+        if seen >= rank:
+            return duration
+    return duration
+
+def summarize(stats, top=5):
+    seconds = 0
+    if stats.get('first') is not None:
+        seconds = max(stats.get('last') - stats.get('first'), 1)
+    record = {
+        'requests': stats.get('requests'),
+        'rate': round(stats.get('requests') / seconds, 2) if seconds else None,
+        'bytes': stats.get('bytes'),
+        'bandwidth': int(stats.get('bytes') / seconds) if seconds else None,
+        'phprequests': stats.get('phprequests'),
+        'p50': percentile(stats.get('durations'), 0.5),
+        'p95': percentile(stats.get('durations'), 0.95),
+        'p99': percentile(stats.get('durations'), 0.99),
+        'top': ['{} ({})'.format(uri.decode('utf-8', 'replace'), hits) for uri, hits in stats.get('uris').most_common(top)],
+        'start': stats.get('first'),
+        'end': stats.get('last')
+    }
+    for digit in '12345':
+        record['{}xx'.format(digit)] = stats.get('status').get(digit.encode(), 0)
+    return record
@@ -0,0 +1,91 @@
+import json
+from .tools import validators
+
+def loadmanifest(path):
+    with open(path) as manifestfile:
+        text = manifestfile.read()
+    if path.endswith('.yaml') or path.endswith('.yml'):
+        try:
+            import yaml
+        except ImportError:
+            raise Exception('PyYAML is required to read YAML manifests. Install it with pip3 install pyyaml or use a JSON manifest.')
+        data = yaml.safe_load(text)
+    else:
+        data = json.loads(text)
+    return normalizemanifest(data or {})
+
+def normalizessl(ssl):
+    if ssl is None:
+        return None
+    if ssl is True or str(ssl).lower() in ['true', 'yes', 'on', 'ssl']:
+        return 'ssl'
+    if ssl is False or str(ssl).lower() in ['false', 'no', 'off', 'none']:
+        return 'none'
+    if str(ssl).lower() == 'forced':
+        return 'forced'
+    raise Exception('Invalid ssl value {}. Use true, false or forced.'.format(ssl))
+
+def normalizemanifest(data):
+    if not isinstance(data, dict):
+        raise Exception('The manifest should be a mapping with users, apps, dbusers and databases keys.')
+    manifest = {
+        'users': [],
+        'apps': [],
+        'dbusers': [],
+        'databases': []
+    }
+    for user in data.get('users') or []:
+        if validators.slug(str(user)) is not True:
+            raise Exception('SSH username {} should only contain letters, dashes/hyphens and numbers.'.format(user))
+        manifest['users'].append(str(user))
+
+    names = []
+    owners = {}
+    for app in data.get('apps') or []:
+        name = str(app.get('name', ''))
+        user = str(app.get('user', ''))
+        if validators.slug(name) is not True or 'dbmetainfo' in name:
+            raise Exception('Invalid app name {}.'.format(name))
+        if validators.slug(user) is not True:
+            raise Exception('Invalid SSH username {} for the app {}.'.format(user, name))
+        if name in names:
+            raise Exception('The app {} is defined more than once.'.format(name))
+        names.append(name)
+        domains = app.get('domains') or []
+        if isinstance(domains, str):
+            domains = domains.split(',')
+        domains = [str(dom).strip() for dom in domains]
+        if not len(domains):
+            raise Exception('The app {} needs at least one domain.'.format(name))
+        for dom in domains:
+            if validators.domain(dom) is not True:
+                raise Exception('{} is not a valid domain.'.format(dom))
+            if dom.lower() in owners:
+                raise Exception('The domain {} is used by both {} and {}.'.format(dom, owners.get(dom.lower()), name))
+            owners[dom.lower()] = name
+        php = app.get('php')
+        manifest['apps'].append({
+            'name': name,
+            'user': user,
+            'php': str(php) if php is not None else None,
+            'domains': domains,
+            'ssl': normalizessl(app.get('ssl'))
+        })
+        if user not in manifest['users']:
+            manifest['users'].append(user)
+
+    for dbuser in data.get('dbusers') or []:
+        name = str(dbuser.get('name', ''))
+        if validators.slug(name) is not True:
+            raise Exception('Invalid MySQL username {}.'.format(name))
+        password = str(dbuser.get('password', ''))
+        if len(password.strip()) < 5:
+            raise Exception('The password for MySQL user {} should contain at least 5 characters.'.format(name))
+        manifest['dbusers'].append({'name': name, 'password': password})
+
+    for db in data.get('databases') or []:
+        name = str(db.get('name', ''))
+        if validators.slug(name) is not True:
+            raise Exception('Invalid database name {}.'.format(name))
+        manifest['databases'].append({'name': name, 'user': str(db.get('user', ''))})
+    return manifest
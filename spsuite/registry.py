@@ -0,0 +1,274 @@
+import os
+import json
+import sqlite3
+import threading
+import time
+
+class AppRegistry:
+    schemaversion = 6
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.conn = None
+
+    def connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            # WAL lets other spsuite processes keep reading while one of them writes.
+            self.conn.execute('PRAGMA journal_mode = WAL')
+        return self.conn
+
+    def needsrebuild(self):
+        with self.lock:
+            version = self.connect().execute('PRAGMA user_version').fetchone()[0]
+            return version != self.schemaversion
+
+    def createschema(self, conn):
+        conn.execute('DROP TABLE IF EXISTS apps')
+        conn.execute('DROP TABLE IF EXISTS domains')
+        conn.execute('DROP TABLE IF EXISTS sizes')
+        conn.execute('DROP TABLE IF EXISTS dbs')
+        conn.execute('DROP TABLE IF EXISTS cache')
+        conn.execute('DROP TABLE IF EXISTS metas')
+        conn.execute('DROP TABLE IF EXISTS logoffsets')
+        conn.execute('CREATE TABLE apps (name TEXT PRIMARY KEY, user TEXT NOT NULL, php TEXT, domains TEXT NOT NULL)')
+        conn.execute('CREATE INDEX apps_user ON apps (user)')
+        conn.execute('CREATE INDEX apps_php ON apps (php)')
+        conn.execute('CREATE TABLE domains (domain TEXT NOT NULL, rdomain TEXT NOT NULL, app TEXT NOT NULL)')
+        conn.execute('CREATE INDEX domains_domain ON domains (domain)')
+        conn.execute('CREATE INDEX domains_rdomain ON domains (rdomain)')
+        conn.execute('CREATE INDEX domains_app ON domains (app)')
+        conn.execute('CREATE TABLE sizes (app TEXT PRIMARY KEY, mtime REAL NOT NULL, size INTEGER NOT NULL, updated REAL NOT NULL)')
+        conn.execute('CREATE TABLE dbs (name TEXT PRIMARY KEY, user TEXT)')
+        conn.execute('CREATE TABLE cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, updated REAL NOT NULL)')
+        conn.execute('CREATE TABLE metas (name TEXT PRIMARY KEY, mtime REAL NOT NULL)')
+        conn.execute('CREATE TABLE logoffsets (path TEXT PRIMARY KEY, app TEXT NOT NULL, inode INTEGER NOT NULL, offset INTEGER NOT NULL, updated REAL NOT NULL)')
+        conn.execute('CREATE INDEX logoffsets_app ON logoffsets (app)')
+
+    def rebuild(self, metas, dbmetas=()):
+        with self.lock:
+            conn = self.connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.createschema(conn)
+                for info in metas:
+                    self.insert(conn, info)
+                for info in dbmetas:
+                    conn.execute('INSERT OR REPLACE INTO dbs (name, user) VALUES (?, ?)', (info.get('name'), info.get('user')))
+                conn.execute('PRAGMA user_version = {}'.format(self.schemaversion))
+                conn.execute('COMMIT')
+            except:
+                conn.execute('ROLLBACK')
+                raise
+
+    def insert(self, conn, info):
+        name = info.get('name')
+        domains = info.get('domains') or []
+        conn.execute('INSERT OR REPLACE INTO apps (name, user, php, domains) VALUES (?, ?, ?, ?)', (name, info.get('user'), info.get('php'), json.dumps(domains)))
+        conn.execute('DELETE FROM domains WHERE app = ?', (name,))
+        conn.executemany('INSERT INTO domains (domain, rdomain, app) VALUES (?, ?, ?)', [(dom.lower(), self.reversedomain(dom), name) for dom in domains])
+
+    def reversedomain(self, domain):
+        return '.'.join(reversed(domain.lower().split('.')))
+
+    def save(self, info):
+        with self.lock:
+            conn = self.connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.insert(conn, info)
+                conn.execute('COMMIT')
+            except:
+                conn.execute('ROLLBACK')
+                raise
+
+    def delete(self, name):
+        with self.lock:
+            conn = self.connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute('DELETE FROM apps WHERE name = ?', (name,))
+                conn.execute('DELETE FROM domains WHERE app = ?', (name,))
+                conn.execute('DELETE FROM sizes WHERE app = ?', (name,))
+                conn.execute('DELETE FROM logoffsets WHERE app = ?', (name,))
+                conn.execute('COMMIT')
+            except:
+                conn.execute('ROLLBACK')
+                raise
+
+    def torecord(self, row):
+        return {
+            'name': row[0],
+            'user': row[1],
+            'php': row[2],
+            'domains': json.loads(row[3])
+        }
+
+    def get(self, name):
+        with self.lock:
+            row = self.connect().execute('SELECT name, user, php, domains FROM apps WHERE name = ?', (name,)).fetchone()
+        if row:
+            return self.torecord(row)
+        return None
+
+    def find(self, user=None, php=None, domain=None):
+        sql = 'SELECT name, user, php, domains FROM apps'
+        conds = []
+        params = []
+        if user:
+            conds.append('user = ?')
+            params.append(user)
+        if php:
+            conds.append('php = ?')
+            params.append(php)
+        if domain:
+            domain = domain.lower()
+            if not any(char in domain for char in '*?['):
+                conds.append('name IN (SELECT app FROM domains WHERE domain = ?)')
+                params.append(domain)
+            elif domain.startswith('*.') and not any(char in domain[2:] for char in '*?['):
+                rsuffix = self.reversedomain(domain[2:])
+                conds.append('name IN (SELECT app FROM domains WHERE rdomain >= ? AND rdomain < ?)')
+                params.extend([rsuffix + '.', rsuffix + '/'])
+            else:
+                conds.append('name IN (SELECT app FROM domains WHERE domain GLOB ?)')
+                params.append(domain)
+        if len(conds):
+            sql += ' WHERE {}'.format(' AND '.join(conds))
+        sql += ' ORDER BY user, name'
+        with self.lock:
+            rows = self.connect().execute(sql, params).fetchall()
+        return [self.torecord(row) for row in rows]
+
+    def domainowners(self, domains):
+        domains = [dom.lower() for dom in domains]
+        if not len(domains):
+            return []
+        sql = 'SELECT domains.domain, apps.name, apps.user FROM domains JOIN apps ON apps.name = domains.app WHERE domains.domain IN ({}) ORDER BY domains.domain, apps.name'.format(', '.join(['?'] * len(domains)))
+        with self.lock:
+            return self.connect().execute(sql, domains).fetchall()
+
+    def lookupdomain(self, domain):
+        domain = domain.lower()
+        labels = domain.split('.')
+        # A domain is served by an exact server_name or by any *.parent wildcard.
+        candidates = [domain] + ['*.{}'.format('.'.join(labels[i:])) for i in range(1, len(labels))]
+        return self.domainowners(candidates)
+
+    def suffixdomains(self, suffix):
+        rsuffix = self.reversedomain(suffix.strip('.'))
+        # Every domain under the suffix sorts between 'com.example.' and 'com.example/'.
+        sql = 'SELECT domains.domain, apps.name, apps.user FROM domains JOIN apps ON apps.name = domains.app WHERE domains.rdomain = ? OR (domains.rdomain >= ? AND domains.rdomain < ?) ORDER BY domains.rdomain, apps.name'
+        with self.lock:
+            return self.connect().execute(sql, (rsuffix, rsuffix + '.', rsuffix + '/')).fetchall()
+
+    def cachedsizes(self):
+        with self.lock:
+            rows = self.connect().execute('SELECT app, mtime, size, updated FROM sizes').fetchall()
+        return {row[0]: (row[1], row[2], row[3]) for row in rows}
+
+    def savesizes(self, sizes):
+        with self.lock:
+            conn = self.connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.executemany('INSERT OR REPLACE INTO sizes (app, mtime, size, updated) VALUES (?, ?, ?, ?)', sizes)
+                conn.execute('COMMIT')
+            except:
+                conn.execute('ROLLBACK')
+                raise
+
+    def dropsize(self, app):
+        with self.lock:
+            self.connect().execute('DELETE FROM sizes WHERE app = ?', (app,))
+
+    def metamtimes(self):
+        with self.lock:
+            rows = self.connect().execute('SELECT name, mtime FROM metas').fetchall()
+        return dict(rows)
+
+    def savemtimes(self, mtimes):
+        with self.lock:
+            conn = self.connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.executemany('INSERT OR REPLACE INTO metas (name, mtime) VALUES (?, ?)', list(mtimes.items()))
+                conn.execute('COMMIT')
+            except:
+                conn.execute('ROLLBACK')
+                raise
+
+    def getmtime(self, name):
+        with self.lock:
+            row = self.connect().execute('SELECT mtime FROM metas WHERE name = ?', (name,)).fetchone()
+        if row:
+            return row[0]
+        return None
+
+    def deletemtime(self, name):
+        with self.lock:
+            self.connect().execute('DELETE FROM metas WHERE name = ?', (name,))
+
+    def logoffsets(self):
+        with self.lock:
+            rows = self.connect().execute('SELECT path, inode, offset FROM logoffsets').fetchall()
+        return {row[0]: (row[1], row[2]) for row in rows}
+
+    def savelogoffsets(self, offsets):
+        now = time.time()
+        with self.lock:
+            conn = self.connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.executemany('INSERT OR REPLACE INTO logoffsets (path, app, inode, offset, updated) VALUES (?, ?, ?, ?, ?)', [(path, app, inode, offset, now) for path, app, inode, offset in offsets])
+                conn.execute('COMMIT')
+            except:
+                conn.execute('ROLLBACK')
+                raise
+
+    def savedb(self, name, user):
+        with self.lock:
+            conn = self.connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute('INSERT OR REPLACE INTO dbs (name, user) VALUES (?, ?)', (name, user))
+                conn.execute("DELETE FROM cache WHERE key = 'dbinventory'")
+                conn.execute('COMMIT')
+            except:
+                conn.execute('ROLLBACK')
+                raise
+
+    def deletedb(self, name):
+        with self.lock:
+            conn = self.connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute('DELETE FROM dbs WHERE name = ?', (name,))
+                conn.execute("DELETE FROM cache WHERE key = 'dbinventory'")
+                conn.execute('COMMIT')
+            except:
+                conn.execute('ROLLBACK')
+                raise
+
+    def dbowners(self):
+        with self.lock:
+            rows = self.connect().execute('SELECT name, user FROM dbs').fetchall()
+        return dict(rows)
+
+    def getcache(self, key, ttl):
+        with self.lock:
+            row = self.connect().execute('SELECT value, updated FROM cache WHERE key = ?', (key,)).fetchone()
+        if row and time.time() - row[1] < ttl:
+            return json.loads(row[0])
+        return None
+
+    def setcache(self, key, value):
+        with self.lock:
+            self.connect().execute('INSERT OR REPLACE INTO cache (key, value, updated) VALUES (?, ?, ?)', (key, json.dumps(value), time.time()))
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
@@ -0,0 +1,101 @@
+import os
+import re
+import mmap
+import time
+import hashlib
+from collections import Counter
+from .logstats import logsegments
+
+# Seconds a slow log must be left alone before its last dump counts as complete.
+settletime = 5
+
+# [10-Oct-2020 13:55:36]  [pool app0] pid 1234
+dumpheader = re.compile(rb'^\[[^\]\n]+\]\s+\[pool [^\]\n]+\] pid \d+\n', re.M)
+
+def slowlogs(logdir, app):
+    logs = []
+    if os.path.isdir(logdir):
+        for name in sorted(os.listdir(logdir)):
+            # One slow log per PHP version the app has used.
+            if name.startswith('{}_php'.format(app)) and name.endswith('.slow.log'):
+                logs.append(os.path.join(logdir, name))
+    return [path for path in logs if os.path.isfile(path)]
+
+def slowsegments(path, inode, offset, settle=settletime):
+    inode, end, segments = logsegments(path, inode, offset)
+    if len(segments) and segments[-1][0] == path and time.time() - os.stat(path).st_mtime < settle:
+        # PHP-FPM may still be writing frames of the last dump; leave it for the next run.
+        path, start, end = segments.pop()
+        with open(path, 'rb') as logfile:
+            with mmap.mmap(logfile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                last = None
+                for match in dumpheader.finditer(data, start, end):
+                    last = match.start()
+        if last is not None and last > start:
+            segments.append((path, start, last))
+            end = last
+        else:
+            end = start
+    return inode, end, segments
+
+def newslowstats():
+    return {
+        'dumps': 0,
+        'stacks': Counter(),
+        'frames': {},
+        'functions': Counter(),
+        'scripts': Counter()
+    }
+
+def fingerprint(frames):
+    return hashlib.sha1('\n'.join(frames).encode('utf-8')).hexdigest()[:12]
+
+def adddump(stats, body):
+    script = None
+    frames = []
+    for line in body.decode('utf-8', 'replace').splitlines():
+        if line.startswith('script_filename = '):
+            script = line[len('script_filename = '):].strip()
+        elif line.startswith('[0x') and '] ' in line:
+            # Addresses differ between workers; the calls and lines do not.
+            frames.append(line.split('] ', 1)[1].strip())
+    stats['dumps'] += 1
+    if script:
+        stats['scripts'][script] += 1
+    if len(frames):
+        key = fingerprint(frames)
+        stats['stacks'][key] += 1
+        stats['frames'].setdefault(key, frames)
+        stats['functions'][frames[0].split(' ', 1)[0]] += 1
+
+def parseslowlog(path, start, stop):
+    stats = newslowstats()
+    with open(path, 'rb') as logfile:
+        with mmap.mmap(logfile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            previous = None
+            for match in dumpheader.finditer(data, start, stop):
+                if previous is not None:
+                    adddump(stats, data[previous:match.start()])
+                previous = match.end()
+            if previous is not None:
+                adddump(stats, data[previous:stop])
+    return stats
+
+def mergeslowstats(total, part):
+    total['dumps'] += part.get('dumps')
+    for key in ['stacks', 'functions', 'scripts']:
+        total[key].update(part.get(key))
+    for key, frames in part.get('frames').items():
+        total['frames'].setdefault(key, frames)
+    return total
+
+def slowrecords(app, stats, top=10):
+    records = []
+    dumps = max(stats.get('dumps'), 1)
+    for key, count in stats.get('stacks').most_common(top):
+        frames = stats.get('frames').get(key)
+        records.append({'app': app, 'kind': 'stack', 'name': frames[0], 'fingerprint': key, 'frames': frames, 'count': count, 'share': round(count * 100.0 / dumps, 1)})
+    for kind, counter in [('function', stats.get('functions')), ('script', stats.get('scripts'))]:
+        for name, count in counter.most_common(top):
+            records.append({'app': app, 'kind': kind, 'name': name, 'fingerprint': None, 'frames': None, 'count': count, 'share': round(count * 100.0 / dumps, 1)})
+    return records
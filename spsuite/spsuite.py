@@ -1,111 +1,244 @@
 #! /usr/bin/env python
 # -*- coding: utf-8 -*-
 import argparse
+import os
 from .utils import ServerPilot
 from termcolor import colored
 import sys
-import validators
 from .tools import *
 from getpass import getpass
-from tabulate import tabulate
 
-def main():
+ignoredbs = ["information_schema", "mysql", "performance_schema", "sys"]
+ignoresqlusers = ["root", "sp-admin", "debian-sys-maint", "mysql.session", "mysql.sys"]
+
+formatarg = (['--format'], {'dest': 'format', 'help': 'Output format: table, json, ndjson or csv (Default: table).', 'choices': outputformats, 'default': 'table'})
+
+dbcolumns = [('name', 'DB Name', None), ('user', 'User', None), ('tables', 'Tables', None), ('type', 'Type', None), ('size', 'Size', lambda size: '{} MB'.format(str(round(size / 1024 / 1024, 2))))]
+dbusercolumns = [('name', 'User Name', None), ('type', 'Type', None)]
+sysusercolumns = [('name', 'User Name', None), ('uid', 'UID', None), ('home', 'Home', None), ('shell', 'Shell', None)]
+trafficcolumns = [('name', 'App', None), ('user', 'SSH User', None), ('requests', 'Requests', None), ('rate', 'Req/s', None), ('bytes', 'Sent', humansize), ('bandwidth', 'Sent/s', humansize), ('2xx', '2xx', None), ('3xx', '3xx', None), ('4xx', '4xx', None), ('5xx', '5xx', None), ('phprequests', 'PHP Requests', None), ('p50', 'PHP p50 ms', None), ('p95', 'PHP p95 ms', None), ('p99', 'PHP p99 ms', None), ('top', 'Top URIs', joinlist), ('start', 'From', datef), ('end', 'To', datef)]
+slowlogcolumns = [('app', 'App', None), ('kind', 'Kind', None), ('count', 'Dumps', None), ('share', 'Share', lambda share: '{}%'.format(share)), ('fingerprint', 'Stack', None), ('name', 'Function / Script', None), ('frames', 'Frames', len)]
+fpmcolumns = [('name', 'App', None), ('user', 'SSH User', None), ('php', 'PHP', None), ('active', 'Active', None), ('idle', 'Idle', None), ('listenqueue', 'Listen Queue', None), ('maxchildren', 'Max Children Reached', None), ('slow', 'Slow Requests', None), ('state', 'State', None)]
+
+def dbrecord(db):
+    if db.get('name') in ignoredbs:
+        db['type'] = 'System'
+    else:
+        db['type'] = 'General'
+    if not db.get('user'):
+        if db.get('name') in ignoredbs:
+            db['user'] = 'root'
+        else:
+            db['user'] = 'N/A'
+    return db
 
-    sp = ServerPilot()
+def dbuserrecord(user):
+    if user in ignoresqlusers:
+        usrtype = 'System User'
+    else:
+        usrtype = 'General User'
+    return {'name': user, 'type': usrtype}
 
-    ignoredbs = ["information_schema", "mysql", "performance_schema", "sys"]
-    ignoresqlusers = ["root", "sp-admin", "debian-sys-maint", "mysql.session", "mysql.sys"]
-
-    ap = argparse.ArgumentParser(description='A powerful tool to manage servers provisioned using ServerPilot.io.')
-    subparsers = ap.add_subparsers(dest="action")
+def phparg(sp):
+    versions = sp.availphpversions()
+    return {'dest': 'php', 'help': 'PHP version (Available: {}).'.format(', '.join(versions)), 'choices': versions, 'required': True}
 
+commands = [
     # SSH Users
-    subparsers.add_parser('listsysusers', help='Show all SSH users existing on this server.')
-    sysuser = subparsers.add_parser('createsysuser', help='Create a new SSH user.')
-    sysuser.add_argument('--username', dest='username', help='Username for your new SSH user.', required=True)
+    ('listsysusers', 'Show all SSH users existing on this server.', [
+        formatarg
+    ]),
+    ('createsysuser', 'Create a new SSH user.', [
+        (['--username'], {'dest': 'username', 'help': 'Username for your new SSH user.', 'required': True})
+    ]),
 
     # Apps
-    listapps = subparsers.add_parser('listapps', help='Show all existing apps.')
-    listapps.add_argument('--user', dest='user', help='SSH user to list apps for.', required=False)
-
-    createapp = subparsers.add_parser('createapp', help='Create a new app.')
-    createapp.add_argument('--name', dest='name', help='The name for your new app.', required=True)
-    createapp.add_argument('--user', dest='user', help='The SSH username for your new app. User will be created if not present.', required=True)
-    createapp.add_argument('--php', dest='php', help='PHP version for your new app.', default=False)
-    createapp.add_argument('--domains', dest='domains', help='Comma-separated domains list, i.e. rehmat.works,www.rehmat.works', required=True)
-
-    updatedomains = subparsers.add_parser('updatedomains', help='Update an apps\' domains and recreate vhost files.')
-    updatedomains.add_argument('--app', dest='app', help='The name of your app for which you want to modify the domains.', required=True)
-    updatedomains.add_argument('--domains', dest='domains', help='Comma-separated domains list, i.e. rehmat.works,www.rehmat.works', required=True)
-
-    changephp = subparsers.add_parser('changephp', help='Change PHP version of an app.')
-    changephp.add_argument('--app', dest='app', help='The name of the app that you want to change PHP version for.', required=True)
-    changephp.add_argument('--php', dest='php', help='PHP version (Available: {}).'.format(', '.join(sp.availphpversions())), choices=sp.availphpversions(), required=True)
-
-    changephpall = subparsers.add_parser('changephpall', help='Change PHP version for all apps.')
-    changephpall.add_argument('--user', dest='user', help='SSH user to update PHP version for their owned apps. If not provided, all apps will be affected with this change.', required=False)
-    changephpall.add_argument('--php', dest='php', help='PHP version (Available: {}).'.format(', '.join(sp.availphpversions())), choices=sp.availphpversions(), required=True)
-
-    delapp = subparsers.add_parser('deleteapp', help='Delete an app permanently.')
-    delapp.add_argument('--name', dest='name', help='The name of the app that you want to delete.', required=True)
-
-    delapps = subparsers.add_parser('delallapps', help='Delete all apps permanently.')
-    delapps.add_argument('--user', dest='user', help='SSH user to delete their owned apps. If not provided, all apps from all users will be deleted.', required=False)
+    ('listapps', 'Show all existing apps.', [
+        (['--user'], {'dest': 'user', 'help': 'SSH user to list apps for.', 'required': False}),
+        (['--no-size', '--fast'], {'dest': 'nosize', 'help': 'Skip the disk usage calculation.', 'action': 'store_true'}),
+        (['--size-ttl'], {'dest': 'sizettl', 'help': 'Seconds to reuse a cached disk usage value for unchanged apps (Default: 3600, 0 disables the cache).', 'type': int, 'default': 3600}),
+        (['--php'], {'dest': 'php', 'help': 'Only show apps running this PHP version.', 'required': False}),
+        (['--ssl'], {'dest': 'ssl', 'help': 'Only show apps in this SSL state.', 'choices': ['none', 'ssl', 'forced'], 'required': False}),
+        (['--domain'], {'dest': 'domain', 'help': 'Only show apps with a matching domain (exact, *.example.com or a glob pattern).', 'required': False}),
+        formatarg
+    ]),
+    ('reindex', 'Rebuild the apps registry from the meta files.', []),
+    ('createapp', 'Create a new app.', [
+        (['--name'], {'dest': 'name', 'help': 'The name for your new app.', 'required': True}),
+        (['--user'], {'dest': 'user', 'help': 'The SSH username for your new app. User will be created if not present.', 'required': True}),
+        (['--php'], {'dest': 'php', 'help': 'PHP version for your new app.', 'default': False}),
+        (['--domains'], {'dest': 'domains', 'help': 'Comma-separated domains list, i.e. rehmat.works,www.rehmat.works', 'required': True})
+    ]),
+    ('updatedomains', 'Update an apps\' domains and recreate vhost files.', [
+        (['--app'], {'dest': 'app', 'help': 'The name of your app for which you want to modify the domains.', 'required': True}),
+        (['--domains'], {'dest': 'domains', 'help': 'Comma-separated domains list, i.e. rehmat.works,www.rehmat.works', 'required': True})
+    ]),
+    ('regenconfigs', 'Re-render NGINX, Apache and PHP-FPM configs for all apps from their templates.', [
+        (['--user'], {'dest': 'user', 'help': 'SSH user to regenerate configs for their owned apps. If not provided, configs for all apps will be regenerated.', 'required': False}),
+        (['--workers'], {'dest': 'workers', 'help': 'Number of apps to render concurrently (Default: 8).', 'type': int, 'default': 8})
+    ]),
+    ('changephp', 'Change PHP version of an app.', [
+        (['--app'], {'dest': 'app', 'help': 'The name of the app that you want to change PHP version for.', 'required': True}),
+        (['--php'], phparg)
+    ]),
+    ('changephpall', 'Change PHP version for all apps.', [
+        (['--user'], {'dest': 'user', 'help': 'SSH user to update PHP version for their owned apps. If not provided, all apps will be affected with this change.', 'required': False}),
+        (['--php'], phparg)
+    ]),
+    ('deleteapp', 'Delete an app permanently.', [
+        (['--name'], {'dest': 'name', 'help': 'The name of the app that you want to delete.', 'required': True})
+    ]),
+    ('delallapps', 'Delete all apps permanently.', [
+        (['--user'], {'dest': 'user', 'help': 'SSH user to delete their owned apps. If not provided, all apps from all users will be deleted.', 'required': False})
+    ]),
+    ('apply', 'Bring users, apps, domains, PHP versions, databases and SSL in line with a manifest file.', [
+        (['manifest'], {'help': 'Path to a YAML or JSON manifest.'}),
+        (['--dry-run'], {'dest': 'dryrun', 'help': 'Only show the changes that would be made.', 'action': 'store_true'}),
+        (['--workers'], {'dest': 'workers', 'help': 'Number of apps to provision concurrently (Default: 4).', 'type': int, 'default': 4})
+    ]),
+    ('whoisdomain', 'Find the app serving a domain. Use *.example.com to list every domain under example.com.', [
+        (['--domain'], {'dest': 'domain', 'help': 'Domain name to look up.', 'required': True})
+    ]),
+    ('tunefpm', 'Size each app\'s PHP-FPM pool from measured worker memory and the server\'s RAM.', [
+        (['--user'], {'dest': 'user', 'help': 'Only tune the apps of this SSH user.', 'required': False}),
+        (['--reserve-mb'], {'dest': 'reservemb', 'help': 'Memory in MB to leave for MySQL, NGINX and the system (Default: a quarter of the RAM, at least 512).', 'type': int, 'default': None}),
+        (['--dry-run'], {'dest': 'dryrun', 'help': 'Only show the calculated settings.', 'action': 'store_true'})
+    ]),
+    ('fpmstatus', 'Query the PHP-FPM status page of every app\'s pool, busiest and unreachable pools first.', [
+        (['--user'], {'dest': 'user', 'help': 'Only show the pools of this SSH user.', 'required': False}),
+        (['--timeout'], {'dest': 'timeout', 'help': 'Seconds to wait for each pool (Default: 2).', 'type': float, 'default': 2}),
+        formatarg
+    ]),
+    ('trafficstats', 'Summarize the access logs of every app: requests, bandwidth, status codes, PHP durations and top URIs. Only lines written since the last run are read.', [
+        (['--user'], {'dest': 'user', 'help': 'Only analyze the apps of this SSH user.', 'required': False}),
+        (['--top'], {'dest': 'top', 'help': 'Number of top URIs to show per app (Default: 5).', 'type': int, 'default': 5}),
+        (['--workers'], {'dest': 'workers', 'help': 'Number of processes parsing logs (Default: one per CPU).', 'type': int, 'default': None}),
+        (['--reset'], {'dest': 'reset', 'help': 'Forget the saved log offsets and read every log from the start.', 'action': 'store_true'}),
+        formatarg
+    ]),
+    ('slowlog', 'Rank the stacks, functions and scripts that show up most in the PHP-FPM slow logs, server-wide (app *) and per app. Only dumps written since the last run are read.', [
+        (['--user'], {'dest': 'user', 'help': 'Only analyze the apps of this SSH user.', 'required': False}),
+        (['--by'], {'dest': 'by', 'help': 'Only show one ranking: stack, function or script.', 'choices': ['stack', 'function', 'script'], 'default': None}),
+        (['--top'], {'dest': 'top', 'help': 'Number of entries per ranking (Default: 10).', 'type': int, 'default': 10}),
+        (['--workers'], {'dest': 'workers', 'help': 'Number of processes parsing logs (Default: one per CPU).', 'type': int, 'default': None}),
+        (['--reset'], {'dest': 'reset', 'help': 'Forget the saved log offsets and read every slow log from the start.', 'action': 'store_true'}),
+        formatarg
+    ]),
+    ('fixperms', 'Reset file ownership of an SSH user\'s home directory or of a single app.', [
+        (['--user'], {'dest': 'user', 'help': 'SSH user whose files should be owned by them.', 'required': False}),
+        (['--app'], {'dest': 'app', 'help': 'Only repair the files of this app.', 'required': False}),
+        (['--workers'], {'dest': 'workers', 'help': 'Number of directories to process concurrently (Default: 8).', 'type': int, 'default': 8})
+    ]),
 
     # MySQL users
-    subparsers.add_parser('listdbusers', help='Show all existing database users.')
-    sqluser = subparsers.add_parser('createsqluser', help='Create a new MySQL user.')
-    sqluser.add_argument('--name', dest='name', help='The name for your new MySQL user.', required=True)
-
-    sqluserpass = subparsers.add_parser('updatesqlpassword', help='Update any MySQL user\'s password.')
-    sqluserpass.add_argument('--user', dest='user', help='The name for MySQL user for which you want to update the password.', required=True)
-
-    deldbuser = subparsers.add_parser('dropuser', help='Drop a MySQL user.')
-    deldbuser.add_argument('--name', dest='name', help='The name of the database user that you want to delete.', required=True)
-
-    subparsers.add_parser('dropallsqlusers', help='Drop all MySQL users except system users ({}).'.format(', '.join(ignoresqlusers)))
+    ('listdbusers', 'Show all existing database users.', [
+        formatarg
+    ]),
+    ('createsqluser', 'Create a new MySQL user.', [
+        (['--name'], {'dest': 'name', 'help': 'The name for your new MySQL user.', 'required': True})
+    ]),
+    ('updatesqlpassword', 'Update any MySQL user\'s password.', [
+        (['--user'], {'dest': 'user', 'help': 'The name for MySQL user for which you want to update the password.', 'required': True})
+    ]),
+    ('dropuser', 'Drop a MySQL user.', [
+        (['--name'], {'dest': 'name', 'help': 'The name of the database user that you want to delete.', 'required': True})
+    ]),
+    ('dropallsqlusers', 'Drop all MySQL users except system users ({}).'.format(', '.join(ignoresqlusers)), []),
 
     # MySQL database
-    subparsers.add_parser('listdbs', help='Show all existing databases.')
-
-    createdb = subparsers.add_parser('createdb', help='Create a new MySQL database.')
-    createdb.add_argument('--name', dest='name', help='The name for your new database.', required=True)
-    createdb.add_argument('--user', dest='user', help='MySQL user for the new database.', required=True)
-
-    dropdb = subparsers.add_parser('dropdb', help='Drop a MySQL database.')
-    dropdb.add_argument('--name', dest='name', help='The name of the database that you want to delete.', required=True)
-    subparsers.add_parser('dropalldbs', help='Drop all databases except system databases ({}).'.format(', '.join(ignoredbs)))
+    ('listdbs', 'Show all existing databases.', [
+        (['--ttl'], {'dest': 'ttl', 'help': 'Seconds to reuse a cached database inventory (Default: 0, always query MySQL).', 'type': int, 'default': 0}),
+        formatarg
+    ]),
+    ('createdb', 'Create a new MySQL database.', [
+        (['--name'], {'dest': 'name', 'help': 'The name for your new database.', 'required': True}),
+        (['--user'], {'dest': 'user', 'help': 'MySQL user for the new database.', 'required': True})
+    ]),
+    ('dropdb', 'Drop a MySQL database.', [
+        (['--name'], {'dest': 'name', 'help': 'The name of the database that you want to delete.', 'required': True})
+    ]),
+    ('dropalldbs', 'Drop all databases except system databases ({}).'.format(', '.join(ignoredbs)), []),
 
     # SSL
-    ssl = subparsers.add_parser('getcert', help='Get letsencrypt cert for an app.')
-    ssl.add_argument('--app', dest='app', help='App name for which you want to get an SSL cert.', required=True)
-
-    sslall = subparsers.add_parser('getcerts', help='Get letsencrypt certs for all apps.')
-    sslall.add_argument('--user', dest='user', help='SSH user to activate SSL for their owned apps. If not provided, SSL will be activated for all apps.', required=False)
-
-    ussl = subparsers.add_parser('removecert', help='Uninstall SSL cert from an app.')
-    ussl.add_argument('--app', dest='app', help='App name from which you want to uninstall the SSL cert.', required=True)
-
-    usslall = subparsers.add_parser('removecerts', help='Uninstall SSL certs for all apps.')
-    usslall.add_argument('--user', dest='user', help='SSH user to remove SSLs for their owned apps. If not provided, SSL will be uninstalled from all apps.', required=False)
-
-    forcessl = subparsers.add_parser('forcessl', help='Force SSL certificate for an app.')
-    forcessl.add_argument('--app', dest='app', help='App name for which you want to force the HTTPS scheme.', required=True)
-
-    unforcessl = subparsers.add_parser('unforcessl', help='Unforce SSL certificate for an app.')
-    unforcessl.add_argument('--app', dest='app', help='App name for which you want to unforce the HTTPS scheme.', required=True)
-
-    forceall = subparsers.add_parser('forceall', help='Force HTTPs for all apps.')
-    forceall.add_argument('--user', dest='user', help='SSH user to force HTTPs for their owned apps. If not provided, SSL will be forced for all apps.', required=False)
+    ('getcert', 'Get letsencrypt cert for an app.', [
+        (['--app'], {'dest': 'app', 'help': 'App name for which you want to get an SSL cert.', 'required': True})
+    ]),
+    ('getcerts', 'Get letsencrypt certs for all apps.', [
+        (['--user'], {'dest': 'user', 'help': 'SSH user to activate SSL for their owned apps. If not provided, SSL will be activated for all apps.', 'required': False}),
+        (['--workers'], {'dest': 'workers', 'help': 'Number of apps to process concurrently (Default: 4).', 'type': int, 'default': 4})
+    ]),
+    ('removecert', 'Uninstall SSL cert from an app.', [
+        (['--app'], {'dest': 'app', 'help': 'App name from which you want to uninstall the SSL cert.', 'required': True})
+    ]),
+    ('removecerts', 'Uninstall SSL certs for all apps.', [
+        (['--user'], {'dest': 'user', 'help': 'SSH user to remove SSLs for their owned apps. If not provided, SSL will be uninstalled from all apps.', 'required': False})
+    ]),
+    ('forcessl', 'Force SSL certificate for an app.', [
+        (['--app'], {'dest': 'app', 'help': 'App name for which you want to force the HTTPS scheme.', 'required': True})
+    ]),
+    ('unforcessl', 'Unforce SSL certificate for an app.', [
+        (['--app'], {'dest': 'app', 'help': 'App name for which you want to unforce the HTTPS scheme.', 'required': True})
+    ]),
+    ('forceall', 'Force HTTPs for all apps.', [
+        (['--user'], {'dest': 'user', 'help': 'SSH user to force HTTPs for their owned apps. If not provided, SSL will be forced for all apps.', 'required': False})
+    ]),
+    ('unforceall', 'Unforce HTTPs for all apps.', [
+        (['--user'], {'dest': 'user', 'help': 'SSH user to unforce HTTPs for their owned apps. If not provided, SSL will be unforced for all apps.', 'required': False})
+    ]),
+
+    # Caching
+    ('enablecache', 'Cache an app\'s pages in NGINX for a short time. Logged-in users, POST requests and admin pages are never cached.', [
+        (['--app'], {'dest': 'app', 'help': 'App name for which you want to enable caching.', 'required': True}),
+        (['--ttl'], {'dest': 'ttl', 'help': 'How long a page stays cached, like 1s, 30s or 5m (Default: 1s).', 'default': '1s'}),
+        (['--max-size'], {'dest': 'maxsize', 'help': 'Maximum disk space for the app\'s cache, like 256m or 1g (Default: 256m).', 'default': '256m'})
+    ]),
+    ('disablecache', 'Stop caching an app\'s pages and delete its cache.', [
+        (['--app'], {'dest': 'app', 'help': 'App name for which you want to disable caching.', 'required': True})
+    ]),
+    ('purgecache', 'Delete cached pages of an app. Without --url or --prefix, the whole cache is emptied.', [
+        (['--app'], {'dest': 'app', 'help': 'App name whose cache should be purged.', 'required': True}),
+        (['--url'], {'dest': 'urls', 'help': 'URL or path to purge. A path is purged on all domains of the app. Can be repeated.', 'action': 'append', 'default': None}),
+        (['--prefix'], {'dest': 'prefixes', 'help': 'Purge every cached URL starting with this URL or path. Can be repeated.', 'action': 'append', 'default': None})
+    ]),
+
+    # Unknown domains
+    ('denyunknown', 'Deny requests from unknown domains.', []),
+    ('allowunknown', 'Allow requests from unknown domains.', []),
+
+    # Daemon
+    ('serve', 'Run the spsuite daemon. Other spsuite commands will talk to it over {}.'.format(defaultsocket), [
+        (['--window'], {'dest': 'window', 'help': 'Milliseconds to wait for more changes before reloading services (Default: 20).', 'type': int, 'default': 20}),
+        (['--workers'], {'dest': 'workers', 'help': 'Number of changes to apply concurrently (Default: 8).', 'type': int, 'default': 8})
+    ])
+]
+
+def buildparser(sp, action=None):
+    ap = argparse.ArgumentParser(description='A powerful tool to manage servers provisioned using ServerPilot.io.')
+    subparsers = ap.add_subparsers(dest="action")
+    names = [command[0] for command in commands]
+    for name, helptext, arguments in commands:
+        if action in names and name != action:
+            continue
+        subparser = subparsers.add_parser(name, help=helptext)
+        for flags, options in arguments:
+            if callable(options):
+                options = options(sp)
+            subparser.add_argument(*flags, **options)
+    return ap
 
-    unforceall = subparsers.add_parser('unforceall', help='Unforce HTTPs for all apps.')
-    unforceall.add_argument('--user', dest='user', help='SSH user to unforce HTTPs for their owned apps. If not provided, SSL will be unforced for all apps.', required=False)
+def main():
 
-    # Deny unknown domains
-    subparsers.add_parser('denyunknown', help='Deny requests from unknown domains.')
+    sp = None
+    if (len(sys.argv) < 2 or sys.argv[1] != 'serve') and not os.environ.get('SPSUITE_NO_DAEMON') and os.path.exists(defaultsocket):
+        from .daemon import connect
+        sp = connect()
+    if sp is None:
+        sp = ServerPilot()
 
-    # Allow unknown domains
-    subparsers.add_parser('allowunknown', help='Allow requests from unknown domains.')
+    if len(sys.argv) > 1:
+        ap = buildparser(sp, sys.argv[1])
+    else:
+        ap = buildparser(sp)
 
     args = ap.parse_args()
 
@@ -113,11 +246,25 @@ def main():
         ap.print_help()
         sys.exit(0)
 
+    if args.action == 'listsysusers':
+        try:
+            printrecords(sp.itersysusers(), sysusercolumns, fmt=args.format, empty='No SSH users found!')
+        except Exception as e:
+            print(colored(str(e), 'yellow'))
+
     if args.action == 'listapps':
         if args.user:
             sp.setuser(args.user)
+        sp.sizettl = args.sizettl
         try:
-            sp.listapps()
+            sp.listapps(size=not args.nosize, fmt=args.format, php=args.php, ssl=args.ssl, domain=args.domain)
+        except Exception as e:
+            print(colored(str(e), 'yellow'))
+
+    if args.action == 'reindex':
+        try:
+            sp.rebuildregistry()
+            print(colored('The apps registry has been rebuilt.', 'green'))
         except Exception as e:
             print(colored(str(e), 'yellow'))
 
@@ -171,6 +318,18 @@ def main():
         except Exception as e:
             print(colored(str(e), 'yellow'))
 
+    if args.action == 'regenconfigs':
+        if args.user:
+            sp.setuser(args.user)
+        try:
+            changes = sp.regenconfigs(workers=args.workers)
+            if len(changes):
+                print(colored('{} config files have been updated and {} reloaded.'.format(len(changes), ', '.join(sorted(sp.changedservices(changes)))), 'green'))
+            else:
+                print(colored('All configs are already up to date.', 'green'))
+        except Exception as e:
+            print(colored(str(e), 'yellow'))
+
     if args.action == 'changephp':
         sp.setphp(args.php)
         sp.setapp(args.app)
@@ -195,6 +354,15 @@ def main():
             except Exception as e:
                 print(colored(str(e), 'yellow'))
 
+    if args.action == 'serve':
+        try:
+            from .daemon import serve
+            serve(window=args.window / 1000.0, workers=args.workers)
+        except KeyboardInterrupt:
+            pass
+        except Exception as e:
+            print(colored(str(e), 'yellow'))
+
     if args.action == 'denyunknown':
         try:
             sp.denyunknown()
@@ -236,6 +404,93 @@ def main():
             except Exception as e:
                 print(colored(str(e), 'yellow'))
 
+    if args.action == 'apply':
+        try:
+            from .manifest import loadmanifest
+            steps = sp.planmanifest(loadmanifest(args.manifest))
+            if not len(steps):
+                print(colored('Everything is already up to date.', 'green'))
+            elif args.dryrun:
+                print(colored(tabulate([[step.get('target'), step.get('action'), step.get('detail')] for step in steps], headers=['Target', 'Action', 'Details']), 'blue'))
+            else:
+                results = sp.applymanifest(steps, workers=args.workers)
+                print(colored(tabulate(results, headers=['Target', 'Action', 'Status', 'Details']), 'green'))
+        except Exception as e:
+            print(colored(str(e), 'yellow'))
+
+    if args.action == 'whoisdomain':
+        try:
+            rows = sp.whoisdomain(args.domain)
+            if len(rows):
+                print(colored(tabulate(rows, headers=['Domain', 'App', 'SSH User']), 'green'))
+            else:
+                print(colored('No app is serving {}.'.format(args.domain), 'yellow'))
+                sys.exit(1)
+        except Exception as e:
+            print(colored(str(e), 'yellow'))
+
+    if args.action == 'tunefpm':
+        if args.user:
+            sp.setuser(args.user)
+        try:
+            reserve = None
+            if args.reservemb is not None:
+                reserve = args.reservemb * 1024 * 1024
+            rows = sp.tunefpm(reserve=reserve, dryrun=args.dryrun)
+            print(colored(tabulate(rows, headers=['App', 'PHP', 'Workers', 'Worker Memory', 'PM', 'Max Children', 'Start', 'Min Spare', 'Max Spare']), 'green'))
+            if args.dryrun:
+                print(colored('Dry run: no pool has been changed.', 'blue'))
+            else:
+                print(colored('PHP-FPM pools have been tuned.', 'green'))
+        except Exception as e:
+            print(colored(str(e), 'yellow'))
+
+    if args.action == 'fpmstatus':
+        if args.user:
+            sp.setuser(args.user)
+        try:
+            printrecords(sp.fpmstatus(timeout=args.timeout), fpmcolumns, fmt=args.format)
+        except Exception as e:
+            print(colored(str(e), 'yellow'))
+
+    if args.action == 'trafficstats':
+        if args.user:
+            sp.setuser(args.user)
+        try:
+            printrecords(sp.trafficstats(top=args.top, workers=args.workers, reset=args.reset), trafficcolumns, fmt=args.format)
+        except Exception as e:
+            print(colored(str(e), 'yellow'))
+
+    if args.action == 'slowlog':
+        if args.user:
+            sp.setuser(args.user)
+        try:
+            records = [record for record in sp.slowlogstats(top=args.top, workers=args.workers, reset=args.reset) if args.by is None or record.get('kind') == args.by]
+            printrecords(records, slowlogcolumns, fmt=args.format, empty='No new slow requests have been logged.')
+        except Exception as e:
+            print(colored(str(e), 'yellow'))
+
+    if args.action == 'fixperms':
+        try:
+            if args.app:
+                sp.setapp(args.app)
+                info = sp.appdetails()
+                if not info:
+                    raise Exception('The app {} does not seem to exist.'.format(args.app))
+                sp.setuser(info.get('user'))
+                sp.fixappperms(workers=args.workers)
+                print(colored('File ownership of the app {} has been repaired.'.format(args.app), 'green'))
+            elif args.user:
+                if not userexists(args.user):
+                    raise Exception('SSH user {} does not exist.'.format(args.user))
+                sp.setuser(args.user)
+                sp.fixuserperms(workers=args.workers)
+                print(colored('File ownership of {}\'s home directory has been repaired.'.format(args.user), 'green'))
+            else:
+                raise Exception('Please provide either --user or --app.')
+        except Exception as e:
+            print(colored(str(e), 'yellow'))
+
     if args.action == 'createsqluser':
         try:
             sp.createsqluser(args.name)
@@ -245,7 +500,7 @@ def main():
 
     if args.action == 'updatesqlpassword':
         try:
-            dbuexists = sqlexec("SELECT * FROM mysql.user WHERE User = '{}'".format(args.user))
+            dbuexists = sqlexec("SELECT * FROM mysql.user WHERE User = %s", (args.user,))
         except:
             dbuexists = False
         if not dbuexists:
@@ -259,39 +514,24 @@ def main():
                 print(colored("Password should contain at least 5 characters.", "yellow"))
         if len(password.strip()) >= 5:
             try:
-                sqlexec("UPDATE mysql.user SET authentication_string=PASSWORD('{}') WHERE USER='{}'".format(password, args.user))
-                sqlexec("FLUSH PRIVILEGES")
+                sqlexecmany([
+                    ("UPDATE mysql.user SET authentication_string=PASSWORD(%s) WHERE USER=%s", (password, args.user)),
+                    ("FLUSH PRIVILEGES", None)
+                ])
                 print(colored('MySQL user {}\'s password has been successfully updated.'.format(args.user), 'green'))
             except Exception as e:
                 try:
-                    sqlexec("UPDATE mysql.user SET Password=PASSWORD('{}') WHERE USER='{}'".format(password, args.user))
-                    sqlexec("FLUSH PRIVILEGES")
+                    sqlexecmany([
+                        ("UPDATE mysql.user SET Password=PASSWORD(%s) WHERE USER=%s", (password, args.user)),
+                        ("FLUSH PRIVILEGES", None)
+                    ])
                     print(colored('MySQL user {}\'s password has been successfully updated.'.format(args.user), 'green'))
                 except:
                     print(colored(str(e), 'yellow'))
 
     if args.action == 'createdb':
         try:
-            dbuexists = sqlexec("SELECT * FROM mysql.user WHERE User = '{}'".format(args.user))
-        except:
-            dbuexists = False;
-        if not dbuexists:
-            print(colored("User {} does not exist. Please create it first.".format(args.user), "yellow"))
-            sys.exit(0)
-
-        if validators.slug(args.name) is not True:
-            print(colored("The database name should only contain letters, numbers, hyphens and dashes.", "yellow"))
-            sys.exit(0)
-
-        try:
-            sqlexec("CREATE DATABASE {}".format(args.name))
-            sqlexec("GRANT ALL PRIVILEGES ON {}.*  TO '{}'@'localhost'".format(args.name, args.user))
-            sqlexec("FLUSH PRIVILEGES")
-            metainfo = {
-                'name': args.name,
-                'user': args.user
-            }
-            sp.savemeta(metainfo, 'dbmetainfo-{}'.format(args.name))
+            sp.createdb(args.name, args.user)
             print(colored("The database {} has been created and all permissions are granted to {} on this database.".format(args.name, args.user), "green"))
         except Exception as e:
             print(colored(str(e), "yellow"))
@@ -320,53 +560,13 @@ def main():
 
     if args.action == 'listdbs':
         try:
-            dbslist = sp.dbslist()
-            dbconn = getdbconn()
-            curr = dbconn.cursor()
-            dbs = []
-            i = 0
-            for db in dbslist:
-                i += 1
-                try:
-                    curr.execute("SELECT table_schema FROM information_schema.tables WHERE table_schema = '{}'".format(str(db).strip()))
-                    tablescount = curr.rowcount
-                    curr.execute("SELECT SUM(data_length + index_length) / 1024 / 1024 AS 'size' FROM information_schema.tables WHERE table_schema = '{}'".format(str(db).strip()))
-                    sizeres = curr.fetchone()
-                    dbsize = float(sizeres[0])
-                except:
-                    tablescount = 0
-                    dbsize = 0
-                if db in ignoredbs:
-                    dbtype = 'System'
-                else:
-                    dbtype = 'General'
-                info = sp.getmeta('dbmetainfo-{}'.format(db))
-                if info:
-                    dbuser = info.get('user')
-                else:
-                    if db in ignoredbs:
-                        dbuser = 'root'
-                    else:
-                        dbuser = 'N/A'
-                dbs.append([i, db, dbuser, tablescount, dbtype, '{} MB'.format(str(round(dbsize, 2)))])
-            dbconn.close()
-            print(colored(tabulate(dbs, headers=['#', 'DB Name', 'User', 'Tables', 'Type', 'Size']), 'green'))
+            printrecords(map(dbrecord, sp.dbinventory(ttl=args.ttl)), dbcolumns, fmt=args.format)
         except Exception as e:
             print(colored(str(e), 'yellow'))
 
     if args.action == 'listdbusers':
         try:
-            dbusers = sp.dbuserslist()
-            i = 0
-            users = []
-            for user in dbusers:
-                i += 1
-                if user in ignoresqlusers:
-                    usrtype = 'System User'
-                else:
-                    usrtype = 'General User'
-                users.append([i, user, usrtype])
-            print(colored(tabulate(users, headers=['#', 'User Name', 'Type']), 'green'))
+            printrecords(map(dbuserrecord, sp.dbuserslist()), dbusercolumns, fmt=args.format)
         except Exception as e:
             print(colored(str(e), 'yellow'))
 
@@ -438,14 +638,13 @@ def main():
             confirmmsg = 'Do you really want to activate SSL for all apps existing on this server?'
         if doconfirm(confirmmsg):
             try:
-                apps = sp.findapps()
-                if len(apps) > 0:
-                    for app in apps:
-                        print(colored('Activating SSL for app {}...'.format(app[1]), 'blue'))
-                        sp.app = app[1]
-                        sp.getcert()
-                else:
-                    raise Exception('No apps found!')
+                print(colored('Activating SSL for apps...', 'blue'))
+                results = sp.getcerts(workers=args.workers)
+                i = 0
+                for result in results:
+                    i += 1
+                    result.insert(0, i)
+                print(colored(tabulate(results, headers=['#', 'App Name', 'Status', 'Details']), 'green'))
             except Exception as e:
                 print(colored(str(e), 'yellow'))
 
@@ -467,15 +666,17 @@ def main():
             confirmmsg = 'Do you really want to uninstall SSL for all apps existing on this server?'
         if doconfirm(confirmmsg):
             try:
-                apps = sp.findapps()
-                if len(apps) > 0:
-                    for app in apps:
-                        print(colored('Removing SSL certificate from app {}...'.format(app[1]), 'blue'))
-                        sp.app = app[1]
+                found = False
+                with sp.batchreload():
+                    for record in sp.iterapps(size=False, ssl=['ssl', 'forced']):
+                        found = True
+                        app = record.get('name')
+                        print(colored('Removing SSL certificate from app {}...'.format(app), 'blue'))
+                        sp.app = app
                         sp.removecert()
-                        print(colored('SSL has been uninstalled from app {}.'.format(app[1]), 'green'))
-                else:
-                    raise Exception('No apps found!')
+                        print(colored('SSL has been uninstalled from app {}.'.format(app), 'green'))
+                if not found:
+                    raise Exception('No apps with an SSL certificate found!')
             except Exception as e:
                 print(colored(str(e), 'yellow'))
 
@@ -496,18 +697,20 @@ def main():
             confirmmsg = 'Do you really want to force SSL for all apps existing on this server?'
         if doconfirm(confirmmsg):
             try:
-                apps = sp.findapps()
-                if len(apps) > 0:
-                    for app in apps:
-                        print(colored('Forcing SSL certificate for app {}...'.format(app[1]), 'blue'))
+                found = False
+                with sp.batchreload():
+                    for record in sp.iterapps(size=False, ssl='ssl'):
+                        found = True
+                        app = record.get('name')
+                        print(colored('Forcing SSL certificate for app {}...'.format(app), 'blue'))
                         try:
-                            sp.app = app[1]
+                            sp.app = app
                             sp.forcessl()
-                            print(colored('SSL has been forced for app {}.'.format(app[1]), 'green'))
+                            print(colored('SSL has been forced for app {}.'.format(app), 'green'))
                         except Exception as e:
                             print(colored(str(e), 'yellow'))
-                else:
-                    raise Exception('No apps found!')
+                if not found:
+                    raise Exception('No apps with an unforced SSL certificate found!')
             except Exception as e:
                 print(colored(str(e), 'yellow'))
 
@@ -520,6 +723,30 @@ def main():
             except Exception as e:
                 print(colored(str(e), 'yellow'))
 
+    if args.action == 'enablecache':
+        try:
+            sp.setapp(args.app)
+            sp.enablecache(ttl=args.ttl, maxsize=args.maxsize)
+            print(colored('Caching has been enabled for the app {}.'.format(args.app), 'green'))
+        except Exception as e:
+            print(colored(str(e), 'yellow'))
+
+    if args.action == 'disablecache':
+        try:
+            sp.setapp(args.app)
+            sp.disablecache()
+            print(colored('Caching has been disabled for the app {}.'.format(args.app), 'green'))
+        except Exception as e:
+            print(colored(str(e), 'yellow'))
+
+    if args.action == 'purgecache':
+        try:
+            sp.setapp(args.app)
+            purged = sp.purgecache(urls=args.urls, prefixes=args.prefixes)
+            print(colored('{} cached pages have been purged for the app {}.'.format(purged, args.app), 'green'))
+        except Exception as e:
+            print(colored(str(e), 'yellow'))
+
     if args.action == 'unforceall':
         if args.user:
             sp.setuser(args.user)
@@ -528,17 +755,19 @@ def main():
             confirmmsg = 'Do you really want to unforce SSL for all apps existing on this server?'
         if doconfirm(confirmmsg):
             try:
-                apps = sp.findapps()
-                if len(apps) > 0:
-                    for app in apps:
-                        print(colored('Unforcing SSL certificate for app {}...'.format(app[1]), 'blue'))
+                found = False
+                with sp.batchreload():
+                    for record in sp.iterapps(size=False, ssl='forced'):
+                        found = True
+                        app = record.get('name')
+                        print(colored('Unforcing SSL certificate for app {}...'.format(app), 'blue'))
                         try:
-                            sp.app = app[1]
+                            sp.app = app
                             sp.unforcessl()
-                            print(colored('SSL has been unforced for app {}.'.format(app[1]), 'green'))
+                            print(colored('SSL has been unforced for app {}.'.format(app), 'green'))
                         except Exception as e:
                             print(colored(str(e), 'yellow'))
-                else:
-                    raise Exception('No apps found!')
+                if not found:
+                    raise Exception('No apps with a forced SSL certificate found!')
             except Exception as e:
                 print(colored(str(e), 'yellow'))
@@ -0,0 +1,14 @@
+;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
+; Generated by spsuite tunefpm from measured worker memory.
+;
+; Run spsuite tunefpm again to recalculate, or delete this file to go back to
+; the defaults in main.conf.
+;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
+
+pm = {{ pm }}
+pm.max_children = {{ max_children }}
+{% if pm == 'dynamic' %}pm.start_servers = {{ start_servers }}
+pm.min_spare_servers = {{ min_spare_servers }}
+pm.max_spare_servers = {{ max_spare_servers }}
+{% else %}pm.process_idle_timeout = {{ process_idle_timeout }}
+{% endif %}
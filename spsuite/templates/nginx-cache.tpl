@@ -0,0 +1,33 @@
+###############################################################################
+# Generated by spsuite enablecache for the app {{ appname }}.
+#
+# Run spsuite disablecache --app {{ appname }} to remove it, or
+# spsuite purgecache --app {{ appname }} to empty the cache.
+###############################################################################
+
+set $spsuite_nocache 0;
+
+if ($request_method !~ ^(GET|HEAD)$) {
+    set $spsuite_nocache 1;
+}
+if ($http_authorization != "") {
+    set $spsuite_nocache 1;
+}
+if ($http_cookie ~* "wordpress_logged_in|wp-postpass|comment_author|woocommerce_items_in_cart|woocommerce_cart_hash|wp_woocommerce_session|PHPSESSID|SESS") {
+    set $spsuite_nocache 1;
+}
+if ($request_uri ~* "^/(wp-admin|wp-login\.php|wp-cron\.php|xmlrpc\.php|wp-json|cart|checkout|my-account|admin|administrator|login)") {
+    set $spsuite_nocache 1;
+}
+
+proxy_cache {{ appname }}_cache;
+proxy_cache_key $scheme$host$request_uri;
+proxy_cache_valid 200 301 302 {{ ttl }};
+proxy_cache_lock on;
+proxy_cache_lock_timeout 5s;
+proxy_cache_use_stale error timeout updating http_500 http_502 http_503 http_504;
+proxy_cache_background_update on;
+proxy_cache_bypass $spsuite_nocache;
+proxy_no_cache $spsuite_nocache;
+
+add_header X-Cache $upstream_cache_status;
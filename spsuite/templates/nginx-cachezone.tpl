@@ -0,0 +1,7 @@
+###############################################################################
+# Generated by spsuite enablecache for the app {{ appname }}.
+#
+# Run spsuite disablecache --app {{ appname }} to remove it.
+###############################################################################
+
+proxy_cache_path /var/cache/nginx-sp/{{ appname }} levels=1:2 keys_zone={{ appname }}_cache:10m max_size={{ maxsize }} inactive=60m use_temp_path=off;
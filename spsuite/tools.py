@@ -1,35 +1,245 @@
 import subprocess
 import os
 from datetime import datetime
-from jinja2 import Environment, BaseLoader
-import pkgutil
+import importlib
 import shutil
 import pwd
-import pymysql
-import configparser
+import grp
 import warnings
+import math
+import threading
+import atexit
+import hashlib
+import stat
+import functools
+import json
+import sys
+from termcolor import colored
+
+class LazyModule:
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attr):
+        if attr in ('name', 'module'):
+            raise AttributeError(attr)
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attr)
+
+jinja2 = LazyModule('jinja2')
+pkgutil = LazyModule('pkgutil')
+configparser = LazyModule('configparser')
+futures = LazyModule('concurrent.futures')
+asyncio = LazyModule('asyncio')
+pymysql = LazyModule('pymysql')
+validators = LazyModule('validators')
+tempfile = LazyModule('tempfile')
+csv = LazyModule('csv')
+
+# Where the spsuite daemon listens; the CLI only loads the daemon client when it exists.
+defaultsocket = '/run/spsuite.sock'
+
+def tabulate(*args, **kwargs):
+    from tabulate import tabulate as tabulatefunc
+    return tabulatefunc(*args, **kwargs)
 
 def du(path):
     return subprocess.check_output(['du','-sh', path]).split()[0].decode('utf-8')
 
+def dirsize(path):
+    total = os.lstat(path).st_blocks * 512
+    stack = [path]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    try:
+                        total += entry.stat(follow_symlinks=False).st_blocks * 512
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+    return total
+
+def humansize(size):
+    for unit in ['', 'K', 'M', 'G', 'T']:
+        if size < 1024 or unit == 'T':
+            break
+        size = size / 1024.0
+    if unit == '':
+        return str(int(size))
+    if size < 10:
+        return '{:.1f}{}'.format(math.ceil(size * 10) / 10, unit)
+    return '{}{}'.format(int(math.ceil(size)), unit)
+
 def cdatef(path):
     ts = int(os.stat(path).st_ctime)
     return datetime.utcfromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')
 
 def mdatef(path):
-    ts = int(os.stat(path).st_mtime)
-    return datetime.utcfromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')
+    return datef(os.stat(path).st_mtime)
+
+def datef(ts):
+    return datetime.utcfromtimestamp(int(ts)).strftime('%Y-%m-%d %H:%M:%S')
+
+def joinlist(value):
+    return ','.join(value)
+
+def loadtpl(template):
+    try:
+        data = pkgutil.get_data('spsuite', 'templates/{}'.format(template))
+    except OSError:
+        return None
+    return data.decode('utf-8'), None, lambda: True
+
+tplenv = None
+tplenvlock = threading.Lock()
+
+def gettplenv():
+    global tplenv
+    if tplenv is None:
+        with tplenvlock:
+            if tplenv is None:
+                try:
+                    bytecodecache = jinja2.FileSystemBytecodeCache()
+                except Exception:
+                    bytecodecache = None
+                tplenv = jinja2.Environment(loader=jinja2.FunctionLoader(loadtpl), bytecode_cache=bytecodecache, auto_reload=False, cache_size=-1)
+    return tplenv
+
+def gettpl(tpl):
+    return gettplenv().get_template(tpl)
+
+def rendertpl(tpl, data={}):
+    return gettpl(tpl).render(**data)
 
 def parsetpl(tpl, data={}):
-    tplstr = str(pkgutil.get_data('spsuite', 'templates/{}'.format(tpl)).decode('utf-8'))
-    tpl = Environment(loader=BaseLoader).from_string(tplstr)
-    return tpl.render(**data)
+    return rendertpl(tpl, data)
 
-def runcmd(cmd):
-    FNULL = open(os.devnull, 'w')
-    if not "sudo" in cmd:
+def filehash(path):
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def fsyncdir(path):
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class WriteBatch:
+    def __init__(self):
+        self.dirs = set()
+        self.lock = threading.Lock()
+
+    def add(self, dirname):
+        with self.lock:
+            self.dirs.add(dirname)
+
+    def commit(self):
+        with self.lock:
+            dirs = sorted(self.dirs)
+            self.dirs = set()
+        for dirname in dirs:
+            # A directory removed later in the batch (delapp) has nothing left to sync.
+            if os.path.isdir(dirname):
+                fsyncdir(dirname)
+
+def atomicwrite(path, data, batch=None):
+    # Readers see either the old file or the complete new one, never a partial write.
+    dirname = os.path.dirname(path)
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    fd, tmppath = tempfile.mkstemp(dir=dirname, prefix='.{}.'.format(os.path.basename(path)), suffix='.spsuite-tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(path):
+            os.chmod(tmppath, stat.S_IMODE(os.stat(path).st_mode))
+        else:
+            os.chmod(tmppath, 0o644)
+        os.replace(tmppath, path)
+    except:
+        if os.path.exists(tmppath):
+            os.unlink(tmppath)
+        raise
+    # The rename itself is durable once the directory is synced; batches sync each directory once.
+    if batch is None:
+        fsyncdir(dirname)
+    else:
+        batch.add(dirname)
+
+def writeconf(path, content, batch=None):
+    data = content.encode('utf-8')
+    if filehash(path) == hashlib.sha1(data).hexdigest():
+        return False
+    atomicwrite(path, data, batch=batch)
+    return True
+
+class CommandError(Exception):
+    def __init__(self, cmd, returncode, stderr):
+        self.cmd = cmd
+        self.returncode = returncode
+        self.stderr = stderr
+        msg = 'Command "{}" failed with exit code {}'.format(cmd, returncode)
+        if stderr.strip():
+            msg += ': {}'.format(stderr.strip())
+        super().__init__(msg)
+
+def privileged(cmd):
+    if os.geteuid() != 0 and not "sudo" in cmd:
         cmd = "sudo {}".format(cmd)
-    subprocess.check_call([cmd], shell=True, stdout=FNULL, stderr=subprocess.STDOUT)
+    return cmd
+
+def runcmd(cmd):
+    proc = subprocess.run([privileged(cmd)], shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        raise CommandError(cmd, proc.returncode, proc.stderr.decode('utf-8', 'ignore'))
+
+# The limit holds per executor, and an executor belongs to one thread at a
+# time: ServerPilot.spawn gives every copy its own, so nested fan-outs (an
+# app job that runs its own commands) cannot wait on their parent's slots.
+class CommandExecutor:
+    def __init__(self, limit=8):
+        self.limit = limit
+        self.semaphore = None
+        self.semaphoreloop = None
+
+    def getsemaphore(self):
+        loop = asyncio.get_running_loop()
+        if self.semaphore is None or self.semaphoreloop is not loop:
+            self.semaphore = asyncio.Semaphore(self.limit)
+            self.semaphoreloop = loop
+        return self.semaphore
+
+    async def run(self, cmd):
+        async with self.getsemaphore():
+            proc = await asyncio.create_subprocess_shell(privileged(cmd), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            stdout, stderr = await proc.communicate()
+            if proc.returncode != 0:
+                raise CommandError(cmd, proc.returncode, stderr.decode('utf-8', 'ignore'))
+
+    async def call(self, func, *args):
+        async with self.getsemaphore():
+            return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args))
+
+    async def gather(self, cmds):
+        results = await asyncio.gather(*[self.run(cmd) for cmd in cmds], return_exceptions=True)
+        errors = [result for result in results if isinstance(result, Exception)]
+        if len(errors):
+            raise errors[0]
+
+    async def map(self, func, items):
+        return await asyncio.gather(*[self.call(func, item) for item in items], return_exceptions=True)
 
 def reloadservice(service):
     runcmd('service {} reload'.format(service))
@@ -37,6 +247,15 @@ def reloadservice(service):
 def restartservice(service):
     runcmd('service {} restart'.format(service))
 
+configtests = {
+    'nginx-sp': 'nginx-sp -t',
+    'apache-sp': 'apachectl-sp configtest'
+}
+
+def testconfig(service):
+    if service in configtests:
+        runcmd(configtests.get(service))
+
 def rmcontent(path):
     if os.path.exists(path):
         if os.path.isdir(path):
@@ -44,6 +263,72 @@ def rmcontent(path):
         else:
             os.unlink(path)
 
+@functools.lru_cache(maxsize=None)
+def phpversions(etcdir):
+    versions = []
+    with os.scandir(etcdir) as entries:
+        for entry in entries:
+            if entry.is_dir() and entry.name.startswith('php') and entry.name.endswith('-sp'):
+                versions.append(getsubstr(entry.name, 'php', '-sp'))
+    return tuple(sorted(versions, key=lambda v: [int(p) if p.isdigit() else p for p in v.split('.')]))
+
+def isroot():
+    return os.geteuid() == 0
+
+def missingdirs(path):
+    missing = []
+    while path and not os.path.exists(path):
+        missing.insert(0, path)
+        path = os.path.dirname(path)
+    return missing
+
+def makedirs(path):
+    created = []
+    for dirpath in missingdirs(path):
+        try:
+            os.mkdir(dirpath)
+            created.append(dirpath)
+        except FileExistsError:
+            pass
+    return created
+
+def getugid(username):
+    pw = pwd.getpwnam(username)
+    try:
+        return pw.pw_uid, grp.getgrnam(username).gr_gid
+    except KeyError:
+        return pw.pw_uid, pw.pw_gid
+
+def chowndir(path, uid, gid):
+    subdirs = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    os.lchown(entry.path, uid, gid)
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                except FileNotFoundError:
+                    pass
+    except FileNotFoundError:
+        pass
+    return subdirs
+
+def chowntree(path, uid, gid, workers=1):
+    os.lchown(path, uid, gid)
+    if workers <= 1:
+        stack = [path]
+        while stack:
+            stack.extend(chowndir(stack.pop(), uid, gid))
+        return
+    with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = set([pool.submit(chowndir, path, uid, gid)])
+        while pending:
+            done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                for subdir in future.result():
+                    pending.add(pool.submit(chowndir, subdir, uid, gid))
+
 def getsubstr(s, start, end):
     return (s.split(start))[1].split(end)[0]
 
@@ -60,21 +345,130 @@ def doconfirm(msg = "Do you really want to perform this irreversible action"):
         answer = input("{} [Y/N] ".format(msg)).lower()
     return answer == "y"
 
+outputformats = ['table', 'json', 'ndjson', 'csv']
+
+def machinevalue(value, fmt):
+    if fmt == 'csv' and isinstance(value, list):
+        return joinlist(value)
+    return value
+
+def printrecords(records, columns, fmt='table', empty=None):
+    # columns are (key, header, formatter) tuples; formatters only apply to tables.
+    keys = [column[0] for column in columns]
+    if fmt == 'table':
+        rows = []
+        for record in records:
+            row = [len(rows) + 1]
+            for key, header, formatter in columns:
+                value = record.get(key)
+                row.append(formatter(value) if formatter and value is not None else value)
+            rows.append(row)
+        if len(rows):
+            print(colored(tabulate(rows, headers=['#'] + [column[1] for column in columns]), 'green'))
+        elif empty:
+            print(colored(empty, 'yellow'))
+    elif fmt == 'json':
+        sep = '\n'
+        sys.stdout.write('[')
+        for record in records:
+            sys.stdout.write(sep + json.dumps({key: record.get(key) for key in keys}))
+            sep = ',\n'
+        sys.stdout.write('\n]\n')
+    elif fmt == 'ndjson':
+        for record in records:
+            sys.stdout.write(json.dumps({key: record.get(key) for key in keys}) + '\n')
+            sys.stdout.flush()
+    elif fmt == 'csv':
+        writer = csv.writer(sys.stdout)
+        writer.writerow(keys)
+        for record in records:
+            writer.writerow([machinevalue(record.get(key), fmt) for key in keys])
+    else:
+        raise Exception('Unknown output format {}. Use one of: {}.'.format(fmt, ', '.join(outputformats)))
+
+class DbConnection:
+    def __init__(self, cnf='/root/.my.cnf'):
+        self.cnf = cnf
+        self.credentials = None
+        self.conn = None
+        self.lock = threading.RLock()
+
+    def getcredentials(self):
+        if self.credentials is None:
+            config = configparser.ConfigParser()
+            config.read(self.cnf)
+            client = config['client']
+            self.credentials = {
+                'host': client.get('host', 'localhost'),
+                'user': client.get('user', 'root'),
+                'password': client['password']
+            }
+        return self.credentials
+
+    def connect(self):
+        with self.lock:
+            try:
+                if self.conn is None:
+                    self.conn = pymysql.connect(autocommit=True, **self.getcredentials())
+                else:
+                    self.conn.ping(reconnect=True)
+                return self.conn
+            except:
+                self.conn = None
+                raise Exception('MySQL connectivity error. Ensure that /root/.my.cnf contains correct login info.')
+
+    def execute(self, sql, params=None):
+        with self.lock, warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            curr = self.connect().cursor()
+            try:
+                return curr.execute(sql, params) > 0
+            finally:
+                curr.close()
+
+    def query(self, sql, params=None):
+        with self.lock, warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            curr = self.connect().cursor()
+            try:
+                curr.execute(sql, params)
+                return curr.fetchall()
+            finally:
+                curr.close()
+
+    def executemany(self, statements):
+        # Statements are (sql, params) pairs run one by one on the shared
+        # connection. There is no transaction: MySQL commits CREATE, DROP and
+        # GRANT implicitly, so a failure leaves the earlier statements applied.
+        with self.lock, warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            curr = self.connect().cursor()
+            try:
+                for sql, params in statements:
+                    curr.execute(sql, params)
+            finally:
+                curr.close()
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                try:
+                    self.conn.close()
+                except:
+                    pass
+                self.conn = None
+
+dbpool = DbConnection()
+atexit.register(dbpool.close)
+
 def getdbconn():
-    try:
-        config = configparser.ConfigParser()
-        config.read('/root/.my.cnf')
-        password = config['client']['password']
-        db = pymysql.connect("localhost", "root", password)
-        return db
-    except:
-        raise Exception('MySQL connectivity error. Ensure that /root/.my.cnf contains correct login info.')
-
-def sqlexec(sql):
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        db = getdbconn()
-        curr = db.cursor()
-        res = curr.execute(sql)
-        db.close()
-        return res  > 0
+    return dbpool.connect()
+
+def sqlexec(sql, params=None):
+    return dbpool.execute(sql, params)
+
+def sqlquery(sql, params=None):
+    return dbpool.query(sql, params)
+
+def sqlexecmany(statements):
+    dbpool.executemany(statements)
@@ -1,25 +1,56 @@
 import os
-from tabulate import tabulate
 from .tools import *
 from termcolor import colored
-import nginx
 import json
-import validators
 from getpass import getpass
+from contextlib import contextmanager
+import time
+import copy
+from .locks import lockfile
+
+certs = LazyModule('spsuite.certs')
+fpm = LazyModule('spsuite.fpm')
+logstats = LazyModule('spsuite.logstats')
+slowlog = LazyModule('spsuite.slowlog')
+cache = LazyModule('spsuite.cache')
+fastcgi = LazyModule('spsuite.fastcgi')
+
+def appaction(method):
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        with self.applock():
+            return method(self, *args, **kwargs)
+    return locked
 
 class ServerPilot:
-    def __init__(self, username = False, app = False):
-        self.mainroot = '/'
+    def __init__(self, username = False, app = False, mainroot = '/'):
+        self.mainroot = mainroot
         self.usrdataroot = os.path.join(self.mainroot, 'srv', 'users')
         self.nginxroot = os.path.join(self.mainroot, 'etc', 'nginx-sp')
         self.apacheroot = os.path.join(self.mainroot, 'etc', 'apache-sp')
         self.sslroot = os.path.join(self.nginxroot, 'le-ssls')
+        self.cacheroot = os.path.join(self.mainroot, 'var', 'cache', 'nginx-sp')
         self.metadir = os.path.join(self.mainroot, 'srv', '.meta')
+        self.lockdir = os.path.join(self.metadir, 'locks')
         self.vhostdir = 'vhosts.d'
         self.username = username
         self.php = '7.3'
         self.app = app
         self.domains = []
+        self.appregistry = None
+        self.sizettl = 3600
+        self.sizeworkers = 8
+        self.dirtyservices = None
+        self.writebatch = None
+        self.acmeserver = None
+        self.executor = CommandExecutor()
+
+    def spawn(self, app):
+        sp = copy.copy(self)
+        sp.app = app
+        sp.domains = []
+        sp.executor = CommandExecutor(self.executor.limit)
+        return sp
 
     def setuser(self, username):
         self.username = username
@@ -67,13 +98,7 @@ class ServerPilot:
         return os.path.join(self.apacheroot, self.vhostdir, '{}.conf'.format(self.app))
 
     def availphpversions(self):
-        os.chdir(os.path.join(self.mainroot, 'etc'))
-        dirs = list(filter(os.path.isdir, os.listdir(os.curdir)))
-        versions = []
-        for dir in dirs:
-            if 'php' in dir and '-sp' in dir:
-                versions.append(getsubstr(dir, 'php', '-sp'))
-        return versions
+        return list(phpversions(os.path.join(self.mainroot, 'etc')))
 
     def phpfpmdir(self):
         return os.path.join(self.mainroot, 'etc', 'php{}-sp'.format(self.php), 'fpm-pools.d')
@@ -83,49 +108,244 @@ class ServerPilot:
             return True
         return False
 
-    def findapps(self):
-        appsdata = []
-        i = 0
-        if not self.username:
-            os.chdir(self.usrdataroot)
-            users = list(filter(os.path.isdir, os.listdir(os.curdir)))
-            if len(users):
-                for user in users:
-                    self.username = user
-                    appsdir = self.appsdir()
-                    if os.path.exists(appsdir):
-                        os.chdir(appsdir)
-                        apps = list(filter(os.path.isdir, os.listdir(os.curdir)))
-                        for app in apps:
-                            self.app = app
-                            if self.isvalidapp():
-                                i += 1
-                                info = self.appdetails()
-                                appsdata.append([i, self.app, info.get('user'), ','.join(info.get('domains')), info.get('php'), du(os.path.join(appsdir, self.app)), mdatef(self.appdir())])
+    def lock(self, name, shared=False):
+        if not os.path.isdir(self.lockdir):
+            self.createdirs([self.lockdir])
+        return lockfile(os.path.join(self.lockdir, '{}.lock'.format(name)), shared=shared)
+
+    def metalock(self, shared=False):
+        return self.lock('meta', shared=shared)
+
+    def applock(self):
+        if not self.app:
+            raise Exception('App name has not been provided.')
+        return self.lock('app-{}'.format(self.app))
+
+    def userlock(self):
+        return self.lock('user-{}'.format(self.username))
+
+    def servicelock(self, service):
+        return self.lock('service-{}'.format(service))
+
+    def registry(self):
+        if self.appregistry is None:
+            from .registry import AppRegistry
+            with self.metalock():
+                appregistry = AppRegistry(os.path.join(self.metadir, 'registry.db'))
+                if appregistry.needsrebuild():
+                    mtimes = self.metafiles()
+                    appregistry.rebuild(self.appmetas(), self.dbmetas())
+                    appregistry.savemtimes(mtimes)
+                self.appregistry = appregistry
+                # Meta files added, removed or renamed behind our back change the directory mtime.
+                dirmtime = os.stat(self.metadir).st_mtime
+                if appregistry.getcache('metadir', float('inf')) != dirmtime:
+                    self.syncregistry()
+                    appregistry.setcache('metadir', dirmtime)
+        return self.appregistry
+
+    def metafiles(self):
+        mtimes = {}
+        if os.path.exists(self.metadir):
+            with os.scandir(self.metadir) as entries:
+                for entry in entries:
+                    if entry.name.endswith('.json'):
+                        mtimes[entry.name[:-5]] = entry.stat().st_mtime
+        return mtimes
+
+    def refreshmeta(self, name):
+        registry = self.registry()
+        jsonfile = os.path.join(self.metadir, '{}.json'.format(name))
+        try:
+            mtime = os.stat(jsonfile).st_mtime
+            info = self.getmeta(name)
+        except OSError:
+            mtime = None
+            info = None
+        except ValueError:
+            # Half-written file; the write that completes it will trigger another refresh.
+            return
+        if mtime is not None and mtime == registry.getmtime(name):
+            return
+        if name.startswith('dbmetainfo-'):
+            if info and info.get('name'):
+                registry.savedb(info.get('name'), info.get('user'))
+            else:
+                registry.deletedb(name[len('dbmetainfo-'):])
+        else:
+            if info and info.get('name') == name:
+                registry.save(info)
+            else:
+                registry.delete(name)
+        if mtime is None:
+            registry.deletemtime(name)
         else:
-            appsdir = self.appsdir()
-            if not os.path.exists(appsdir):
-                raise Exception('Looks like you have provided an invalid SSH user.')
+            registry.savemtimes({name: mtime})
+
+    def syncregistry(self):
+        known = self.registry().metamtimes()
+        current = self.metafiles()
+        changed = [name for name, mtime in current.items() if known.get(name) != mtime]
+        changed.extend([name for name in known if name not in current])
+        for name in changed:
+            self.refreshmeta(name)
+        return changed
+
+    def appmetas(self):
+        if os.path.exists(self.metadir):
+            with os.scandir(self.metadir) as entries:
+                for entry in entries:
+                    if entry.name.endswith('.json') and not entry.name.startswith('dbmetainfo-'):
+                        info = self.getmeta(entry.name[:-5])
+                        if info and info.get('name'):
+                            yield info
+
+    def dbmetas(self):
+        if os.path.exists(self.metadir):
+            with os.scandir(self.metadir) as entries:
+                for entry in entries:
+                    if entry.name.endswith('.json') and entry.name.startswith('dbmetainfo-'):
+                        info = self.getmeta(entry.name[:-5])
+                        if info and info.get('name'):
+                            yield info
+
+    def rebuildregistry(self):
+        with self.metalock():
+            self.registry().rebuild(self.appmetas(), self.dbmetas())
+
+    def appsizes(self, appdirs, cached=None):
+        sizes = {}
+        stale = []
+        if cached is None:
+            cached = self.registry().cachedsizes()
+        now = time.time()
+        for app, (appdir, mtime) in appdirs.items():
+            entry = cached.get(app)
+            if entry and entry[0] == mtime and now - entry[2] < self.sizettl:
+                sizes[app] = entry[1]
             else:
-                os.chdir(appsdir)
-                apps = list(filter(os.path.isdir, os.listdir(os.curdir)))
-                for app in apps:
-                    self.app = app
-                    if self.isvalidapp():
-                        i += 1
-                        info = self.appdetails()
-                        appsdata.append([i, self.app, info.get('user'), ','.join(info.get('domains')), info.get('php'), du(self.appdir()), mdatef(self.appdir())])
+                stale.append((app, appdir, mtime))
+        if len(stale):
+            with futures.ThreadPoolExecutor(max_workers=self.sizeworkers) as pool:
+                results = list(pool.map(lambda item: dirsize(item[1]), stale))
+            fresh = []
+            for item, size in zip(stale, results):
+                sizes[item[0]] = size
+                fresh.append((item[0], item[2], size, now))
+            self.registry().savesizes(fresh)
+        return sizes
+
+    def existingapps(self, infos):
+        for info in infos:
+            appdir = os.path.join(self.usrdataroot, info.get('user'), 'apps', info.get('name'))
+            try:
+                st = os.stat(appdir)
+            except OSError:
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                info['appdir'] = appdir
+                info['mtime'] = st.st_mtime
+                yield info
+
+    def withsizes(self, records):
+        # Sizes are computed a chunk at a time so rows can be emitted before the whole scan ends.
+        # The size cache is read once; chunks only add to it.
+        cached = None
+        chunk = []
+        for record in records:
+            if cached is None:
+                cached = self.registry().cachedsizes()
+            chunk.append(record)
+            if len(chunk) >= self.sizeworkers * 4:
+                yield from self.sizechunk(chunk, cached)
+                chunk = []
+        yield from self.sizechunk(chunk, cached)
+
+    def sizechunk(self, chunk, cached=None):
+        if len(chunk):
+            sizes = self.appsizes({record.get('name'): (record.get('appdir'), record.get('mtime')) for record in chunk}, cached=cached)
+            for record in chunk:
+                record['size'] = sizes.get(record.get('name'))
+                yield record
+
+    def withssl(self, records, states):
+        for record in records:
+            record['ssl'] = self.spawn(record.get('name')).sslstate()
+            if record.get('ssl') in states:
+                yield record
+
+    def iterapps(self, size=True, php=None, ssl=None, domain=None):
+        if self.username and not os.path.exists(self.appsdir()):
+            raise Exception('Looks like you have provided an invalid SSH user.')
+        # Cheap filters run first: user, PHP and domain in SQL, then SSL state, then disk usage.
+        records = self.existingapps(self.registry().find(user=self.username, php=php, domain=domain))
+        if ssl:
+            if isinstance(ssl, str):
+                ssl = [ssl]
+            records = self.withssl(records, ssl)
+        if size:
+            records = self.withsizes(records)
+        return records
+
+    def findapps(self, size=True):
+        appsdata = []
+        for record in self.iterapps(size=size):
+            row = [len(appsdata) + 1, record.get('name'), record.get('user'), joinlist(record.get('domains')), record.get('php')]
+            if size:
+                row.append(humansize(record.get('size')))
+            row.append(datef(record.get('mtime')))
+            appsdata.append(row)
         return appsdata
 
-    def listapps(self):
-        appsdata = self.findapps()
-        if len(appsdata):
-            print(colored(tabulate(appsdata, headers=['#', 'App Name', 'SSH User', 'Domains', 'PHP', 'Disk Used', 'Modified']), 'green'))
+    def appcolumns(self, size=True):
+        columns = [('name', 'App Name', None), ('user', 'SSH User', None), ('domains', 'Domains', joinlist), ('php', 'PHP', None)]
+        if size:
+            columns.append(('size', 'Disk Used', humansize))
+        columns.append(('mtime', 'Modified', datef))
+        return columns
+
+    def listapps(self, size=True, fmt='table', php=None, ssl=None, domain=None):
+        printrecords(self.iterapps(size=size, php=php, ssl=ssl, domain=domain), self.appcolumns(size), fmt=fmt, empty='Looks like you have not created any apps yet!')
+
+    def createdirs(self, paths):
+        if isroot():
+            created = []
+            for path in paths:
+                created.extend(makedirs(path))
+            return created
+        created = []
+        for path in paths:
+            created.extend([dirpath for dirpath in missingdirs(path) if dirpath not in created])
+        if len(created):
+            self.runcmds(['mkdir -p {}'.format(path) for path in paths if not os.path.exists(path)])
+        return created
+
+    def chownpaths(self, paths, recursive=False, workers=1):
+        if not len(paths):
+            return
+        if isroot():
+            uid, gid = getugid(self.username)
+            for path in paths:
+                if recursive:
+                    chowntree(path, uid, gid, workers)
+                else:
+                    os.lchown(path, uid, gid)
         else:
-            print(colored('Looks like you have not created any apps yet!', 'yellow'))
+            runcmd("chown {}{}:{} {}".format('-R ' if recursive else '', self.username, self.username, ' '.join(paths)))
+
+    def fixappperms(self, workers=1):
+        paths = [
+            self.appdir(),
+            os.path.join(self.usrhome(), 'log', self.app),
+            os.path.join(self.usrhome(), 'tmp', self.app)
+        ]
+        self.chownpaths([path for path in paths if os.path.exists(path)], recursive=True, workers=workers)
+
+    def fixuserperms(self, workers=8):
+        self.chownpaths([self.usrhome()], recursive=True, workers=workers)
 
-    def fixappperms(self):
-        runcmd("chown -R {}:{} {}".format(self.username, self.username, self.usrhome()))
+    def inusrhome(self, path):
+        return path == self.usrhome() or path.startswith(self.usrhome() + os.sep)
 
     def userdirs(self):
         return [
@@ -157,23 +377,30 @@ class ServerPilot:
         ]
 
     def savemeta(self, data, filename):
-        if not os.path.exists(self.metadir):
-            runcmd('mkdir -p {}'.format(self.metadir))
-        with open(os.path.join(self.metadir, '{}.json'.format(filename)), 'w') as metafile:
-            metafile.write(json.dumps(data))
+        jsonfile = os.path.join(self.metadir, '{}.json'.format(filename))
+        with self.metalock():
+            atomicwrite(jsonfile, json.dumps(data).encode('utf-8'), batch=self.writebatch)
+            self.registry().savemtimes({filename: os.stat(jsonfile).st_mtime})
 
     def getmeta(self, filename):
         jsonfile = os.path.join(self.metadir, '{}.json'.format(filename))
         data = None
         if os.path.exists(jsonfile):
-            with open(jsonfile) as jsondata:
-                data = json.load(jsondata)
+            with self.metalock(shared=True):
+                with open(jsonfile) as jsondata:
+                    data = json.load(jsondata)
         return data
 
     def deletemeta(self, filename):
         jsonfile = os.path.join(self.metadir, '{}.json'.format(filename))
-        if os.path.exists(jsonfile):
-            rmcontent(jsonfile)
+        with self.metalock():
+            if os.path.exists(jsonfile):
+                rmcontent(jsonfile)
+            if filename.startswith('dbmetainfo-'):
+                self.registry().deletedb(filename[len('dbmetainfo-'):])
+            else:
+                self.registry().delete(filename)
+            self.registry().deletemtime(filename)
 
     def saveappmeta(self):
         if not self.app:
@@ -184,7 +411,18 @@ class ServerPilot:
             'php': self.php,
             'domains': self.domains
         }
-        self.savemeta(metainfo, self.app)
+        with self.metalock():
+            self.savemeta(metainfo, self.app)
+            self.registry().save(metainfo)
+
+    def savedbmeta(self, name, user):
+        metainfo = {
+            'name': name,
+            'user': user
+        }
+        with self.metalock():
+            self.savemeta(metainfo, 'dbmetainfo-{}'.format(name))
+            self.registry().savedb(name, user)
 
     def gettpldata(self):
         if len(self.domains) > 1:
@@ -209,47 +447,237 @@ class ServerPilot:
             'serveralias': serveralias
         }
 
-    def createnginxvhost(self):
+    def nginxconfigs(self, tpl='nginx.tpl'):
         data = self.gettpldata()
-        nginxmaindata = parsetpl('nginx-main.tpl')
-        with open(os.path.join(self.nginxroot, self.vhostdir, '{}.d'.format(self.app), 'main.conf'), 'w') as nginxmain:
-            nginxmain.write(nginxmaindata)
-        nginxtpldata = parsetpl('nginx.tpl', data=data)
-        with open(self.appnginxconf(), 'w') as nginxconf:
-            nginxconf.write(nginxtpldata)
+        if tpl != 'nginx.tpl':
+            data.update({'sslpath': self.sslroot})
+        return [
+            (os.path.join(self.nginxroot, self.vhostdir, '{}.d'.format(self.app), 'main.conf'), parsetpl('nginx-main.tpl'), 'nginx-sp'),
+            (self.appnginxconf(), parsetpl(tpl, data=data), 'nginx-sp')
+        ]
 
-    def createnginxsslvhost(self):
+    def apacheconfigs(self):
         data = self.gettpldata()
-        data.update({'sslpath': self.sslroot})
-        nginxtpldata = parsetpl('nginx-ssl.tpl', data=data)
-        with open(self.appnginxconf(), 'w') as nginxconf:
-            nginxconf.write(nginxtpldata)
+        return [
+            (os.path.join(self.apacheroot, self.vhostdir, '{}.d'.format(self.app), 'main.conf'), parsetpl('apache-main.tpl'), 'apache-sp'),
+            (self.appapacheconf(), parsetpl('apache.tpl', data=data), 'apache-sp')
+        ]
 
-    def createnginxsslforcedvhost(self):
+    def fpmconfigs(self):
         data = self.gettpldata()
-        data.update({'sslpath': self.sslroot})
-        nginxtpldata = parsetpl('nginx-sslforced.tpl', data=data)
-        with open(self.appnginxconf(), 'w') as nginxconf:
-            nginxconf.write(nginxtpldata)
+        service = 'php{}-fpm-sp'.format(self.php)
+        return [
+            (os.path.join(self.phpfpmdir(), '{}.d'.format(self.app), 'main.conf'), parsetpl('fpm-main.tpl'), service),
+            (os.path.join(self.phpfpmdir(), '{}.conf'.format(self.app)), parsetpl('fpm.tpl', data=data), service)
+        ]
+
+    def nginxvhosttpl(self):
+        if self.apphasssl():
+            conf = self.appnginxconf()
+            if os.path.exists(conf):
+                with open(conf) as nginxconf:
+                    if 'return 301 https://' in nginxconf.read():
+                        return 'nginx-sslforced.tpl'
+            return 'nginx-ssl.tpl'
+        return 'nginx.tpl'
+
+    def appconfigs(self):
+        return self.nginxconfigs(self.nginxvhosttpl()) + self.apacheconfigs() + self.fpmconfigs()
+
+    def writeconfigs(self, configs):
+        changes = []
+        for path, content, service in configs:
+            if writeconf(path, content, batch=self.writebatch):
+                changes.append((path, service))
+        return changes
+
+    def changedservices(self, changes):
+        return set(service for path, service in changes)
+
+    def createnginxvhost(self):
+        return self.writeconfigs(self.nginxconfigs())
+
+    def createnginxsslvhost(self):
+        return self.writeconfigs(self.nginxconfigs('nginx-ssl.tpl'))
+
+    def createnginxsslforcedvhost(self):
+        return self.writeconfigs(self.nginxconfigs('nginx-sslforced.tpl'))
 
     def createapachevhost(self):
-        data = self.gettpldata()
-        apachemaindata = parsetpl('apache-main.tpl')
-        with open(os.path.join(self.apacheroot, self.vhostdir, '{}.d'.format(self.app), 'main.conf'), 'w') as apachemain:
-            apachemain.write(apachemaindata)
-        apachetpldata = parsetpl('apache.tpl', data=data)
-        with open(self.appapacheconf(), 'w') as apacheconf:
-            apacheconf.write(apachetpldata)
+        return self.writeconfigs(self.apacheconfigs())
 
     def createfpmpool(self):
-        data = self.gettpldata()
-        fpmconfdir = os.path.join(self.phpfpmdir(), '{}.d'.format(self.app))
-        fpmmaindata = parsetpl('fpm-main.tpl')
-        with open(os.path.join(fpmconfdir, 'main.conf'), 'w') as fpmmain:
-            fpmmain.write(fpmmaindata)
-        fpmconfdata = parsetpl('fpm.tpl', data=data)
-        with open(os.path.join(self.phpfpmdir(), '{}.conf'.format(self.app)), 'w') as fpmconf:
-            fpmconf.write(fpmconfdata)
+        return self.writeconfigs(self.fpmconfigs())
+
+    def regenconfigs(self, workers=8):
+        apps = self.registry().find(user=self.username)
+
+        def regenjob(info):
+            sp = self.spawn(info.get('name'))
+            sp.username = info.get('user')
+            sp.php = info.get('php')
+            sp.domains = info.get('domains')
+            return sp.writeconfigs(sp.appconfigs())
+
+        changes = []
+        with self.batchreload():
+            with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+                for result in pool.map(regenjob, apps):
+                    changes.extend(result)
+            self.markdirty(*self.changedservices(changes))
+        return changes
+
+    def tunefpm(self, reserve=None, dryrun=False):
+        procdir = os.path.join(self.mainroot, 'proc')
+        memory = fpm.meminfo(procdir).get('MemTotal')
+        if not memory:
+            raise Exception('Could not read the total memory of this server from {}.'.format(procdir))
+        if reserve is None:
+            reserve = max(memory // 4, 512 * 1024 * 1024)
+        budget = memory - reserve
+        if budget <= 0:
+            raise Exception('The memory reserve is larger than the total memory of this server.')
+        apps = list(self.iterapps(size=False))
+        if not len(apps):
+            raise Exception('No apps found!')
+        samples = fpm.poolmemory(procdir)
+        # Every pool on the server gets one share of the budget, busy pools one
+        # share per running worker, even when only one user's pools are rewritten.
+        allapps = self.registry().find()
+        weights = {app.get('name'): max(len(samples.get(app.get('name'), [])), 1) for app in allapps}
+        total = sum(weights.values())
+        configs = []
+        rows = []
+        for app in apps:
+            workers = samples.get(app.get('name'), [])
+            if len(workers):
+                workermem = sum(workers) / len(workers)
+            else:
+                workermem = fpm.defaultworkermem
+            settings = fpm.poolsettings(workermem, budget * weights.get(app.get('name')) / total, len(workers))
+            sp = self.spawn(app.get('name'))
+            sp.php = app.get('php')
+            path = os.path.join(sp.phpfpmdir(), '{}.d'.format(app.get('name')), 'tuning.conf')
+            configs.append((path, parsetpl('fpm-tuning.tpl', data=settings), 'php{}-fpm-sp'.format(app.get('php'))))
+            rows.append([app.get('name'), app.get('php'), len(workers), humansize(workermem), settings.get('pm'), settings.get('max_children'), settings.get('start_servers', '-'), settings.get('min_spare_servers', '-'), settings.get('max_spare_servers', '-')])
+        if not dryrun:
+            with self.batchreload():
+                changes = self.writeconfigs(configs)
+                self.markdirty(*self.changedservices(changes))
+        return rows
+
+    def fpmsocket(self, app, user):
+        return os.path.join(self.usrdataroot, user, 'run', '{}.php-fpm.sock'.format(app))
+
+    async def apoolstatus(self, app, timeout, semaphore):
+        record = {'name': app.get('name'), 'user': app.get('user'), 'php': app.get('php'), 'state': 'OK'}
+        async with semaphore:
+            try:
+                status = await fastcgi.fpmstatus(self.fpmsocket(app.get('name'), app.get('user')), timeout=timeout)
+            except asyncio.TimeoutError:
+                status = None
+                record['state'] = 'Timed out'
+            except (FileNotFoundError, ConnectionRefusedError):
+                status = None
+                record['state'] = 'Not running'
+            except Exception as e:
+                status = None
+                record['state'] = str(e) or e.__class__.__name__
+        status = status or {}
+        record.update({
+            'active': status.get('active processes'),
+            'idle': status.get('idle processes'),
+            'listenqueue': status.get('listen queue'),
+            'maxlistenqueue': status.get('max listen queue'),
+            'maxchildren': status.get('max children reached'),
+            'slow': status.get('slow requests'),
+            'accepted': status.get('accepted conn')
+        })
+        return record
+
+    async def afpmstatus(self, apps, timeout, limit):
+        semaphore = asyncio.Semaphore(limit)
+        return await asyncio.gather(*[self.apoolstatus(app, timeout, semaphore) for app in apps])
+
+    def fpmstatus(self, timeout=2, limit=64):
+        apps = list(self.iterapps(size=False))
+        if not len(apps):
+            raise Exception('No apps found!')
+        records = asyncio.run(self.afpmstatus(apps, timeout, limit))
+        # Unreachable and saturated pools first, then the busiest.
+        return sorted(records, key=lambda record: (record.get('state') == 'OK', -(record.get('listenqueue') or 0), -(record.get('maxchildren') or 0), -(record.get('slow') or 0), -(record.get('active') or 0), record.get('name')))
+
+    def applogdir(self, app, user):
+        return os.path.join(self.usrdataroot, user, 'log', app)
+
+    def trafficstats(self, top=5, workers=None, reset=False):
+        apps = list(self.iterapps(size=False))
+        if not len(apps):
+            raise Exception('No apps found!')
+        with self.lock('logs'):
+            offsets = {}
+            if not reset:
+                offsets = self.registry().logoffsets()
+            jobs = []
+            saved = []
+            for app in apps:
+                for kind, path in logstats.accesslogs(self.applogdir(app.get('name'), app.get('user')), app.get('name')):
+                    inode, offset = offsets.get(path, (None, 0))
+                    inode, end, segments = logstats.logsegments(path, inode, offset)
+                    jobs.extend([(app.get('name'), kind, chunk) for chunk in logstats.chunks(segments)])
+                    saved.append((path, app.get('name'), inode, end))
+            stats = {app.get('name'): logstats.newstats() for app in apps}
+            if len(jobs) > 1 and workers != 1:
+                # Chunks are parsed in separate processes; each one maps its part of the log.
+                with futures.ProcessPoolExecutor(max_workers=workers) as pool:
+                    parts = pool.map(logstats.parsechunk, *zip(*[(kind, path, start, stop) for name, kind, (path, start, stop) in jobs]))
+                    for (name, kind, chunk), part in zip(jobs, parts):
+                        logstats.mergestats(stats.get(name), part)
+            else:
+                for name, kind, (path, start, stop) in jobs:
+                    logstats.mergestats(stats.get(name), logstats.parsechunk(kind, path, start, stop))
+            self.registry().savelogoffsets(saved)
+        records = []
+        for app in apps:
+            record = logstats.summarize(stats.get(app.get('name')), top=top)
+            record.update({'name': app.get('name'), 'user': app.get('user')})
+            records.append(record)
+        return sorted(records, key=lambda record: (-record.get('requests'), -record.get('phprequests'), record.get('name')))
+
+    def slowlogstats(self, top=10, workers=None, reset=False):
+        apps = list(self.iterapps(size=False))
+        if not len(apps):
+            raise Exception('No apps found!')
+        with self.lock('logs'):
+            offsets = {}
+            if not reset:
+                offsets = self.registry().logoffsets()
+            jobs = []
+            saved = []
+            for app in apps:
+                for path in slowlog.slowlogs(self.applogdir(app.get('name'), app.get('user')), app.get('name')):
+                    inode, offset = offsets.get(path, (None, 0))
+                    inode, end, segments = slowlog.slowsegments(path, inode, offset)
+                    jobs.extend([(app.get('name'), segment) for segment in segments])
+                    saved.append((path, app.get('name'), inode, end))
+            stats = {app.get('name'): slowlog.newslowstats() for app in apps}
+            if len(jobs) > 1 and workers != 1:
+                # A stack dump spans several lines, so logs are split per file rather than per chunk.
+                with futures.ProcessPoolExecutor(max_workers=workers) as pool:
+                    parts = pool.map(slowlog.parseslowlog, *zip(*[segment for name, segment in jobs]))
+                    for (name, segment), part in zip(jobs, parts):
+                        slowlog.mergeslowstats(stats.get(name), part)
+            else:
+                for name, (path, start, stop) in jobs:
+                    slowlog.mergeslowstats(stats.get(name), slowlog.parseslowlog(path, start, stop))
+            self.registry().savelogoffsets(saved)
+        total = slowlog.newslowstats()
+        records = []
+        for app in apps:
+            slowlog.mergeslowstats(total, stats.get(app.get('name')))
+            records.extend(slowlog.slowrecords(app.get('name'), stats.get(app.get('name')), top=top))
+        # Server-wide ranking first, under app '*', then each app's own.
+        return slowlog.slowrecords('*', total, top=top) + records
 
     def deletefpmpool(self, php):
         oriphp = self.php
@@ -262,23 +690,30 @@ class ServerPilot:
         for dir in dirs:
             if os.path.exists(dir):
                 rmcontent(dir)
-        reloadservice('php{}-fpm-sp'.format(php))
+        self.markdirty('php{}-fpm-sp'.format(php))
         self.php = oriphp
 
     def createindex(self):
         with open(os.path.join(self.appdir(), 'public', 'index.php'), 'w') as indexf:
             indexf.write('<?php phpinfo();?>')
 
+    async def aruncmds(self, cmds):
+        await self.executor.gather(cmds)
+
+    def runcmds(self, cmds):
+        asyncio.run(self.aruncmds(cmds))
+
+    async def aforeachapp(self, apps, method):
+        return await self.executor.map(lambda app: getattr(self.spawn(app), method)(), apps)
+
+    def foreachapp(self, apps, method):
+        return asyncio.run(self.aforeachapp(apps, method))
+
     def createuser(self):
         runcmd('useradd {}'.format(self.username))
-        runcmd('usermod -a -G sp-sysusers {}'.format(self.username, self.username))
-        runcmd('usermod --shell /bin/bash {}'.format(self.username))
-        runcmd('usermod -d {} {}'.format(self.usrhome(), self.username))
+        runcmd('usermod -a -G sp-sysusers --shell /bin/bash -d {} {}'.format(self.usrhome(), self.username))
 
-        userdirs = self.userdirs()
-        for usrdir in userdirs:
-            if not os.path.exists(usrdir):
-                runcmd('mkdir -p {}'.format(usrdir))
+        self.createdirs(self.userdirs())
 
         bashprofiledata = parsetpl('bashprofile.tpl')
         with open(os.path.join(self.usrhome(), '.profile'), 'w') as bp:
@@ -291,97 +726,171 @@ class ServerPilot:
         bashrcdata = parsetpl('bashrc.tpl')
         with open(os.path.join(self.usrhome(), '.bashrc'), 'w') as brc:
             brc.write(bashrcdata)
-        self.fixappperms()
+        self.fixuserperms()
+
+    def servicepriority(self, service):
+        if service.startswith('php'):
+            return 0
+        if service == 'apache-sp':
+            return 1
+        return 2
+
+    def reloaddirty(self, services):
+        failed = {}
+        for service in sorted(services, key=self.servicepriority):
+            with self.servicelock(service):
+                try:
+                    testconfig(service)
+                except Exception as e:
+                    failed[service] = str(e)
+                    continue
+                try:
+                    reloadservice(service)
+                except:
+                    restartservice(service)
+        return failed
+
+    def reloaderror(self, failed):
+        return Exception('Configuration test failed, not reloaded: {}'.format(', '.join(['{} ({})'.format(service, error) for service, error in failed.items()])))
+
+    def flushservices(self, services):
+        failed = self.reloaddirty(services)
+        if len(failed):
+            raise self.reloaderror(failed)
+
+    def markdirty(self, *services):
+        if self.dirtyservices is None:
+            self.flushservices(services)
+        else:
+            self.dirtyservices.update(services)
+
+    @contextmanager
+    def batchreload(self):
+        if self.dirtyservices is not None:
+            yield
+            return
+        self.dirtyservices = set()
+        self.writebatch = WriteBatch()
+        try:
+            yield
+        finally:
+            services = self.dirtyservices
+            writebatch = self.writebatch
+            self.dirtyservices = None
+            self.writebatch = None
+            writebatch.commit()
+            self.flushservices(services)
 
     def reloadservices(self):
-        restartservice('nginx-sp')
-        restartservice('apache-sp')
-        restartservice('php{}-fpm-sp'.format(self.php))
+        self.markdirty('nginx-sp', 'apache-sp', 'php{}-fpm-sp'.format(self.php))
 
+    @appaction
     def createapp(self):
-        if not self.app:
-            raise Exception('App name has not been provided.')
-
         if not self.username:
             raise Exception('SSH user has not been provided.')
 
-        if not userexists(self.username):
-            self.createuser()
+        # Reserve the app name and its domains before touching any config.
+        with self.metalock():
+            if self.appdetails():
+                raise Exception('An app with name {} already exists.'.format(self.app))
+            self.checkdomains()
+            self.saveappmeta()
 
-        # Create app dirs
-        appdirs = self.appdirs()
-        appdirs.append(os.path.join(self.appdir(), 'public'))
-        for ad in appdirs:
-            runcmd('mkdir -p {}'.format(ad))
+        try:
+            with self.userlock():
+                if not userexists(self.username):
+                    self.createuser()
 
-        # Create NGINX vhost
-        self.createnginxvhost()
+            # Create app dirs
+            appdirs = self.appdirs()
+            appdirs.append(os.path.join(self.appdir(), 'public'))
+            created = self.createdirs(appdirs)
 
-        # Create Apache vhost
-        self.createapachevhost()
+            # Create NGINX vhost
+            self.createnginxvhost()
 
-        # Create PHP-FPM pools
-        self.createfpmpool()
+            # Create Apache vhost
+            self.createapachevhost()
 
-        # Save app meta info
-        self.saveappmeta()
+            # Create PHP-FPM pools
+            self.createfpmpool()
 
-        # Create index file
-        self.createindex()
+            # Create index file
+            self.createindex()
 
-        # Fix app permissions
-        self.fixappperms()
+            # Fix app permissions
+            ownedpaths = [path for path in created if self.inusrhome(path)]
+            ownedpaths.append(os.path.join(self.appdir(), 'public', 'index.php'))
+            self.chownpaths(ownedpaths)
+        except:
+            # Release the reserved name and anything created so far.
+            self.delapp()
+            raise
         try:
+            testconfig('nginx-sp')
+            testconfig('apache-sp')
             self.reloadservices()
         except Exception as e:
             self.delapp()
             self.reloadservices()
+            if self.dirtyservices is not None:
+                # Batched callers (the daemon) only see what is raised.
+                raise Exception('The app {} has been removed again: {}'.format(self.app, str(e)))
             print(colored(str(e), 'red'))
 
     def appdetails(self):
         if not self.app:
             raise Exception('App name has not been provided.')
-        return self.getmeta(self.app)
-
+        info = self.registry().get(self.app)
+        if info is None:
+            info = self.getmeta(self.app)
+            if info and info.get('name') == self.app:
+                self.registry().save(info)
+        return info
+
+    @appaction
     def delapp(self):
-        if not self.app:
-            raise Exception('App name has not been provided.')
         appinfo = self.appdetails()
         if appinfo:
+            certerror = None
             if self.apphasssl():
                 try:
                     self.removecert()
-                except:
-                    pass
+                except Exception as e:
+                    # Delete the app anyway, but do not hide the certificate that is still valid.
+                    certerror = e
             self.username = appinfo.get('user')
             self.php = appinfo.get('php')
             appdirs = self.appdirs()
             appdirs.append(self.appapacheconf())
             appdirs.append(self.appnginxconf())
             appdirs.append(os.path.join(self.phpfpmdir(), '{}.conf'.format(self.app)))
-            appdirs.append(os.path.join(self.metadir, '{}.json'.format(self.app)))
+            appdirs.append(self.appcachezone())
+            appdirs.append(self.appcachedir())
             for path in appdirs:
                 rmcontent(path)
+            self.deletemeta(self.app)
             self.reloadservices()
+            if certerror is not None:
+                raise Exception('The app {} has been deleted, but its SSL certificate was not revoked: {}'.format(self.app, str(certerror)))
 
     def allowunknown(self):
         defaultvhost = os.path.join(self.nginxroot, 'http.d', 'default_server.conf')
         if os.path.exists(defaultvhost):
             rmcontent(defaultvhost)
-            self.reloadservices()
+            self.markdirty('nginx-sp')
         else:
             raise Exception('Default vhost file exists and unknown domains are already allowed.')
 
     def denyunknown(self):
         defaultvhost = os.path.join(self.nginxroot, 'http.d', 'default_server.conf')
         if not os.path.exists(defaultvhost):
-            defaultvhostdata = parsetpl('defaultserver.tpl')
-            with open(defaultvhost, 'w') as dv:
-                dv.write(defaultvhostdata)
-            self.reloadservices()
+            writeconf(defaultvhost, parsetpl('defaultserver.tpl'), batch=self.writebatch)
+            self.markdirty('nginx-sp')
         else:
             raise Exception('Unknown domains are already being denied.')
 
+    @appaction
     def changephpversion(self):
         info = self.appdetails()
         if info:
@@ -390,99 +899,164 @@ class ServerPilot:
             else:
                 self.deletefpmpool(info.get('php'))
                 self.username = info.get('user')
+                self.domains = info.get('domains')
                 fpmconfmain = os.path.join(self.phpfpmdir(), '{}.d'.format(self.app))
-                if not os.path.exists(fpmconfmain):
-                    runcmd('mkdir -p {}'.format(fpmconfmain))
+                self.createdirs([fpmconfmain])
                 self.createfpmpool()
-                reloadservice('php{}-fpm-sp'.format(self.php))
+                self.markdirty('php{}-fpm-sp'.format(self.php))
                 self.saveappmeta()
         else:
             raise Exception('Provided app name seem to be invalid.')
 
+    def appnames(self, **filters):
+        return [record.get('name') for record in self.iterapps(size=False, **filters)]
+
     def deleteallapps(self):
-        apps = self.findapps()
+        apps = self.appnames()
         if len(apps) > 0:
-            for app in apps:
-                self.app = app[1]
-                self.delapp()
+            with self.batchreload():
+                results = self.foreachapp(apps, 'delapp')
+            failed = []
+            for app, result in zip(apps, results):
+                if isinstance(result, Exception):
+                    failed.append('{} ({})'.format(app, str(result)))
+            if len(failed):
+                raise Exception('Some apps could not be deleted: {}'.format(', '.join(failed)))
         else:
             raise Exception('No apps found!')
 
     def changephpall(self):
-        apps = self.findapps()
+        apps = [record.get('name') for record in self.iterapps(size=False) if record.get('php') != self.php]
         if len(apps) > 0:
-            for app in apps:
-                self.app = app[1]
-                try:
-                    self.changephpversion()
-                except Exception as e:
-                    pass
+            with self.batchreload():
+                self.foreachapp(apps, 'changephpversion')
         else:
             raise Exception('No apps found!')
 
+    @appaction
     def updatedomains(self):
         info = self.appdetails()
         if info:
-            self.username = info.get('user')
-            self.createnginxvhost()
-            self.createapachevhost()
-            self.saveappmeta()
-            reloadservice('nginx-sp')
-            reloadservice('apache-sp')
+            with self.metalock():
+                self.checkdomains()
+                self.username = info.get('user')
+                self.php = info.get('php')
+                changes = self.createnginxvhost() + self.createapachevhost()
+                self.saveappmeta()
+            self.markdirty(*self.changedservices(changes))
         else:
             raise Exception('The app {} does not seem to exist.'.format(self.app))
 
     def dropsqluser(self, user):
         try:
-            sqlexec("REVOKE ALL PRIVILEGES, GRANT OPTION FROM '{}'@'localhost'".format(user))
+            sqlexec("REVOKE ALL PRIVILEGES, GRANT OPTION FROM %s@'localhost'", (user,))
         except:
             pass
-        sqlexec("DROP USER '{}'@'localhost'".format(user))
+        sqlexec("DROP USER %s@'localhost'", (user,))
 
-    def createsqluser(self, user):
+    def askpassword(self):
+        password = ""
+        while len(password.strip()) < 5:
+            password = getpass()
+            if len(password.strip()) < 5:
+                print(colored("Password should contain at least 5 characters.", "yellow"))
+        return password
+
+    def createsqluser(self, user, password=None):
         if validators.slug(user) is not True:
             raise Exception("The database user contains unsupported characters.")
         try:
-            userexists = sqlexec("SELECT * FROM mysql.user WHERE User = '{}'".format(user))
+            userexists = sqlexec("SELECT * FROM mysql.user WHERE User = %s", (user,))
         except:
             userexists = False
         if userexists:
             raise Exception('A MySQL user with username {} already exists.'.format(user))
-        password = ""
-        while len(password.strip()) < 5:
-            password = getpass()
-            if len(password.strip()) < 5:
-                print(colored("Password should contain at least 5 characters.", "yellow"))
+        if password is None:
+            password = self.askpassword()
         if len(password.strip()) >= 5:
-            sqlexec("CREATE USER '{}'@'localhost' IDENTIFIED BY '{}'".format(user, password))
-            sqlexec("FLUSH PRIVILEGES")
+            sqlexecmany([
+                ("CREATE USER %s@'localhost' IDENTIFIED BY %s", (user, password)),
+                ("FLUSH PRIVILEGES", None)
+            ])
+
+    def createdb(self, db, user):
+        try:
+            dbuexists = sqlexec("SELECT * FROM mysql.user WHERE User = %s", (user,))
+        except:
+            dbuexists = False
+        if not dbuexists:
+            raise Exception("User {} does not exist. Please create it first.".format(user))
+        if validators.slug(db) is not True:
+            raise Exception("The database name should only contain letters, numbers, hyphens and dashes.")
+        sqlexecmany([
+            ("CREATE DATABASE `{}`".format(db), None),
+            ("GRANT ALL PRIVILEGES ON `{}`.* TO %s@'localhost'".format(db), (user,)),
+            ("FLUSH PRIVILEGES", None)
+        ])
+        self.savedbmeta(db, user)
 
     def dropdb(self, db):
-        sqlexec("DROP DATABASE {}".format(db))
+        if validators.slug(db) is not True:
+            raise Exception("The database name should only contain letters, numbers, hyphens and dashes.")
+        sqlexec("DROP DATABASE `{}`".format(db))
         self.deletemeta('dbmetainfo-{}'.format(db))
 
     def dbslist(self):
-        dbconn = getdbconn()
-        curr = dbconn.cursor()
-        curr.execute("SHOW DATABASES")
-        dbsres = curr.fetchall()
-        dbconn.close()
+        dbsres = sqlquery("SHOW DATABASES")
         dbs = []
         for db in dbsres:
             dbs.append(db[0])
         return dbs
 
+    def dbinventory(self, ttl=0):
+        if ttl:
+            cached = self.registry().getcache('dbinventory', ttl)
+            if cached is not None:
+                return cached
+        rows = sqlquery("SELECT s.SCHEMA_NAME, COUNT(t.TABLE_NAME), COALESCE(SUM(t.DATA_LENGTH + t.INDEX_LENGTH), 0) FROM information_schema.SCHEMATA s LEFT JOIN information_schema.TABLES t ON t.TABLE_SCHEMA = s.SCHEMA_NAME GROUP BY s.SCHEMA_NAME ORDER BY s.SCHEMA_NAME")
+        owners = self.registry().dbowners()
+        inventory = []
+        for row in rows:
+            inventory.append({
+                'name': row[0],
+                'user': owners.get(row[0]),
+                'tables': int(row[1]),
+                'size': float(row[2])
+            })
+        if ttl:
+            self.registry().setcache('dbinventory', inventory)
+        return inventory
+
+    def itersysusers(self):
+        try:
+            members = grp.getgrnam('sp-sysusers').gr_mem
+        except KeyError:
+            members = []
+        for member in sorted(members):
+            try:
+                pw = pwd.getpwnam(member)
+            except KeyError:
+                continue
+            yield {'name': pw.pw_name, 'uid': pw.pw_uid, 'home': pw.pw_dir, 'shell': pw.pw_shell}
+
     def dbuserslist(self):
-        dbconn = getdbconn()
-        curr = dbconn.cursor()
-        curr.execute("SELECT User FROM mysql.user")
-        usersres = curr.fetchall()
-        dbconn.close()
+        usersres = sqlquery("SELECT User FROM mysql.user")
         users = []
         for user in usersres:
             users.append(user[0])
         return users
 
+    def whoisdomain(self, domain):
+        domain = domain.strip().lower()
+        if domain.startswith('*.'):
+            return [list(row) for row in self.registry().suffixdomains(domain[2:])]
+        return [list(row) for row in self.registry().lookupdomain(domain)]
+
+    def checkdomains(self):
+        conflicts = [row for row in self.registry().domainowners(self.domains) if row[1] != self.app]
+        if len(conflicts):
+            raise Exception('The domain {} is already used by the app {}.'.format(conflicts[0][0], conflicts[0][1]))
+
     def search(self, value, data):
         for conf in data:
             blocks = conf.get('server')
@@ -492,49 +1066,214 @@ class ServerPilot:
                     return found
         return None
 
-    def getcert(self):
+    def reachabledomains(self, webroot, domains):
+        with certs.challengedir(webroot) as challengepath:
+            with futures.ThreadPoolExecutor(max_workers=max(len(domains), 1)) as pool:
+                results = list(pool.map(lambda domain: certs.checkwebroot(domain, challengepath), domains))
+        return [domain for domain, ok in zip(domains, results) if ok]
+
+    def issuecert(self, webroot, domains):
+        domainsstr = ''
+        for vd in domains:
+            domainsstr += ' -d {}'.format(vd)
+        acmeserver = self.acmeserver or certs.defaultacmeserver
+        cmd = "certbot certonly --non-interactive --agree-tos --register-unsafely-without-email --webroot -w {} --cert-name {} --config-dir {} --server {}{}".format(webroot, self.app, self.sslroot, acmeserver, domainsstr)
+        certs.getlimiter(acmeserver).acquire()
+        with certs.certbotlock:
+            runcmd(cmd)
+
+    @appaction
+    def activatessl(self):
         if not self.isvalidapp():
             raise Exception('A valid app name is not provided.')
-        with open(self.appnginxconf()) as nginxconf:
-            nginxconfbackup = nginxconf.read()
         details = self.appdetails()
         self.setuser(details.get('user'))
         self.domains = details.get('domains')
-        validdoms = []
-        try:
-            for domain in details.get('domains'):
-                cmd = "certbot certonly --non-interactive --dry-run --webroot -w {} --register-unsafely-without-email --agree-tos -d {}".format(os.path.join(self.appdir(), 'public'), domain)
-                runcmd(cmd)
-                validdoms.append(domain)
-        except Exception as e:
-            print(str(e))
-            pass
-
+        webroot = os.path.join(self.appdir(), 'public')
+        validdoms = self.reachabledomains(webroot, details.get('domains'))
         if len(validdoms) > 0:
-            domainsstr = ''
-            webroot = os.path.join(self.appdir(), 'public')
-            for vd in validdoms:
-                domainsstr += ' -d {}'.format(vd)
-            cmd = "certbot certonly --non-interactive --agree-tos --register-unsafely-without-email --webroot -w {} --cert-name {} --config-dir {}{}".format(webroot, self.app, self.sslroot, domainsstr)
-            runcmd(cmd)
-            self.createnginxsslvhost()
-            try:
-                reloadservice('nginx-sp')
-                print(colored('SSL activated for app {} (Domains Secured: {})'.format(self.app, ' '.join(validdoms)), 'green'))
-            except:
+            self.issuecert(webroot, validdoms)
+            # nginx -t reads every vhost, so concurrent activations take turns
+            # writing, testing and rolling back; a test only sees our own change.
+            with self.servicelock('nginx-sp'):
+                with open(self.appnginxconf()) as nginxconf:
+                    nginxconfbackup = nginxconf.read()
+                self.createnginxsslvhost()
                 try:
-                    restartservice('nginx-sp')
+                    testconfig('nginx-sp')
                 except:
-                    with open(self.appnginxconf(), 'w') as restoreconf:
-                        restoreconf.write(nginxconfbackup)
-                    restartservice('nginx-sp')
+                    writeconf(self.appnginxconf(), nginxconfbackup, batch=self.writebatch)
                     raise Exception('SSL activation failed!')
+            self.markdirty('nginx-sp')
+        return validdoms
+
+    def getcert(self):
+        validdoms = self.activatessl()
+        if len(validdoms) > 0:
+            print(colored('SSL activated for app {} (Domains Secured: {})'.format(self.app, ' '.join(validdoms)), 'green'))
         else:
             print('SSL not available for this app yet.')
 
+    def getcerts(self, workers=4):
+        apps = self.appnames()
+        if not len(apps):
+            raise Exception('No apps found!')
+
+        def certjob(app):
+            try:
+                validdoms = self.spawn(app).activatessl()
+                if len(validdoms) > 0:
+                    return [app, 'Secured', ' '.join(validdoms)]
+                return [app, 'Skipped', 'No domain is reachable over HTTP yet.']
+            except Exception as e:
+                return [app, 'Failed', str(e)]
+
+        with self.batchreload():
+            with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+                return list(pool.map(certjob, apps))
+
+    def sslstate(self):
+        tpl = self.nginxvhosttpl()
+        if tpl == 'nginx-sslforced.tpl':
+            return 'forced'
+        if tpl == 'nginx-ssl.tpl' and self.apphasssl():
+            return 'ssl'
+        return 'none'
+
+    def planapp(self, app):
+        steps = []
+        sp = self.spawn(app.get('name'))
+        sp.domains = app.get('domains')
+        sp.checkdomains()
+        info = sp.appdetails()
+        php = app.get('php')
+        if php and php not in self.availphpversions():
+            raise Exception('The PHP version {} requested for the app {} is not available on your system.'.format(php, app.get('name')))
+        if not info:
+            steps.append({'action': 'createapp', 'detail': 'user {}, PHP {}, domains {}'.format(app.get('user'), php or self.php, ','.join(app.get('domains')))})
+            current = 'none'
+            hascert = False
+        else:
+            if info.get('user') != app.get('user'):
+                raise Exception('The app {} belongs to {}, not {}. Apps cannot be moved between users.'.format(app.get('name'), info.get('user'), app.get('user')))
+            sp.setuser(info.get('user'))
+            current = sp.sslstate()
+            hascert = sp.apphasssl()
+            if php and info.get('php') != php:
+                steps.append({'action': 'changephp', 'detail': 'PHP {} -> {}'.format(info.get('php'), php)})
+        desired = app.get('ssl')
+        if desired is None:
+            # No ssl key keeps whatever the app has today.
+            desired = current
+        if info and info.get('domains') != app.get('domains'):
+            steps.append({'action': 'updatedomains', 'detail': ','.join(app.get('domains'))})
+            # updatedomains writes a plain vhost; SSL is issued again below for the new domains.
+            current = 'none'
+        if desired == 'none':
+            # Only an explicit ssl: none revokes a certificate.
+            if app.get('ssl') == 'none' and hascert:
+                steps.append({'action': 'removecert', 'detail': ''})
+        else:
+            if current == 'none':
+                steps.append({'action': 'getcert', 'detail': ''})
+                current = 'ssl'
+            if desired == 'forced' and current != 'forced':
+                steps.append({'action': 'forcessl', 'detail': ''})
+            elif desired == 'ssl' and current == 'forced':
+                steps.append({'action': 'unforcessl', 'detail': ''})
+        for step in steps:
+            step.update({'phase': 'apps', 'target': app.get('name'), 'app': app})
+        return steps
+
+    def planmanifest(self, manifest):
+        steps = []
+        for user in manifest.get('users'):
+            if not userexists(user):
+                steps.append({'phase': 'users', 'target': user, 'action': 'createsysuser', 'detail': ''})
+        if len(manifest.get('dbusers')) or len(manifest.get('databases')):
+            dbusers = self.dbuserslist()
+            dbs = self.dbslist()
+            for dbuser in manifest.get('dbusers'):
+                if dbuser.get('name') not in dbusers:
+                    steps.append({'phase': 'databases', 'target': dbuser.get('name'), 'action': 'createsqluser', 'detail': '', 'password': dbuser.get('password')})
+            for db in manifest.get('databases'):
+                if db.get('name') not in dbs:
+                    steps.append({'phase': 'databases', 'target': db.get('name'), 'action': 'createdb', 'detail': 'owner {}'.format(db.get('user')), 'user': db.get('user')})
+        for app in manifest.get('apps'):
+            steps.extend(self.planapp(app))
+        return steps
+
+    def runstep(self, step):
+        action = step.get('action')
+        if action == 'createsysuser':
+            sp = self.spawn(False)
+            sp.setuser(step.get('target'))
+            sp.createuser()
+        elif action == 'createsqluser':
+            self.createsqluser(step.get('target'), password=step.get('password'))
+        elif action == 'createdb':
+            self.createdb(step.get('target'), step.get('user'))
+        else:
+            app = step.get('app')
+            sp = self.spawn(app.get('name'))
+            sp.setuser(app.get('user'))
+            sp.domains = app.get('domains')
+            if app.get('php'):
+                sp.php = app.get('php')
+            elif action != 'createapp':
+                # Keep the version the app runs; the spawned default is not it.
+                info = sp.appdetails()
+                if info:
+                    sp.php = info.get('php')
+            if action == 'createapp':
+                sp.createapp()
+                if not sp.isvalidapp():
+                    raise Exception('The app {} could not be created.'.format(app.get('name')))
+            elif action == 'changephp':
+                sp.changephpversion()
+            elif action == 'updatedomains':
+                sp.updatedomains()
+            elif action == 'getcert':
+                if not len(sp.activatessl()):
+                    raise Exception('No domain is reachable over HTTP yet.')
+            elif action == 'removecert':
+                sp.removecert()
+            elif action == 'forcessl':
+                sp.forcessl()
+            elif action == 'unforcessl':
+                sp.unforcessl()
+
+    def applymanifest(self, steps, workers=4):
+        results = []
+
+        def appjob(appsteps):
+            appresults = []
+            for step in appsteps:
+                try:
+                    self.runstep(step)
+                    appresults.append([step.get('target'), step.get('action'), 'Done', step.get('detail')])
+                except Exception as e:
+                    appresults.append([step.get('target'), step.get('action'), 'Failed', str(e)])
+                    break
+            return appresults
+
+        with self.batchreload():
+            for step in steps:
+                if step.get('phase') != 'apps':
+                    results.extend(appjob([step]))
+            appsteps = {}
+            for step in steps:
+                if step.get('phase') == 'apps':
+                    appsteps.setdefault(step.get('target'), []).append(step)
+            executor = CommandExecutor(workers)
+            for appresults in asyncio.run(executor.map(appjob, list(appsteps.values()))):
+                results.extend(appresults)
+        return results
+
     def apphasssl(self):
         return os.path.exists(os.path.join(self.sslroot, 'live', self.app, 'fullchain.pem'))
 
+    @appaction
     def removecert(self):
         if not self.isvalidapp():
             raise Exception('A valid app name should be provided.')
@@ -547,16 +1286,15 @@ class ServerPilot:
         self.setuser(details.get('user'))
         cmd = "certbot --non-interactive revoke --config-dir {} --cert-name {}".format(self.sslroot, self.app)
         try:
-            runcmd(cmd)
+            with certs.certbotlock:
+                runcmd(cmd)
             self.createnginxvhost()
-            try:
-                reloadservice('nginx-sp')
-            except:
-                restartservice('nginx-sp')
+            self.markdirty('nginx-sp')
 
         except Exception as e:
             raise Exception("SSL certificate cannot be removed: {}".format(str(e)))
 
+    @appaction
     def forcessl(self):
         if not self.isvalidapp():
             raise Exception('A valid app name should be provided.')
@@ -565,12 +1303,10 @@ class ServerPilot:
         details = self.appdetails()
         self.setuser(details.get('user'))
         self.domains = details.get('domains')
-        self.createnginxsslforcedvhost()
-        try:
-            reloadservice('nginx-sp')
-        except:
-            restartservice('nginx-sp')
+        changes = self.createnginxsslforcedvhost()
+        self.markdirty(*self.changedservices(changes))
 
+    @appaction
     def unforcessl(self):
         if not self.isvalidapp():
             raise Exception('A valid app name should be provided.')
@@ -578,10 +1314,61 @@ class ServerPilot:
         self.setuser(details.get('user'))
         self.domains = details.get('domains')
         if self.apphasssl():
-            self.createnginxsslvhost()
+            changes = self.createnginxsslvhost()
         else:
-            self.createnginxvhost()
-        try:
-            reloadservice('nginx-sp')
-        except:
-            restartservice('nginx-sp')
+            changes = self.createnginxvhost()
+        self.markdirty(*self.changedservices(changes))
+
+    def appcachezone(self):
+        return os.path.join(self.nginxroot, 'http.d', 'cache-{}.conf'.format(self.app))
+
+    def appcacheconf(self):
+        return os.path.join(self.nginxroot, self.vhostdir, '{}.d'.format(self.app), 'cache.conf')
+
+    def appcachedir(self):
+        return os.path.join(self.cacheroot, self.app)
+
+    def appcacheenabled(self):
+        return os.path.exists(self.appcacheconf())
+
+    @appaction
+    def enablecache(self, ttl='1s', maxsize='256m'):
+        if not self.isvalidapp():
+            raise Exception('A valid app name should be provided.')
+        if not cache.validttl(ttl):
+            raise Exception('{} is not a valid cache time. Use seconds or a value like 5s, 1m or 1h.'.format(ttl))
+        if not cache.validsize(maxsize):
+            raise Exception('{} is not a valid cache size. Use a value like 256m or 1g.'.format(maxsize))
+        data = {'appname': self.app, 'ttl': ttl, 'maxsize': maxsize.lower()}
+        changes = self.writeconfigs([
+            (self.appcachezone(), parsetpl('nginx-cachezone.tpl', data=data), 'nginx-sp'),
+            (self.appcacheconf(), parsetpl('nginx-cache.tpl', data=data), 'nginx-sp')
+        ])
+        self.markdirty(*self.changedservices(changes))
+
+    @appaction
+    def disablecache(self):
+        if not self.isvalidapp():
+            raise Exception('A valid app name should be provided.')
+        if not self.appcacheenabled() and not os.path.exists(self.appcachezone()):
+            raise Exception('Caching is not enabled for the app {}.'.format(self.app))
+        for path in [self.appcacheconf(), self.appcachezone(), self.appcachedir()]:
+            rmcontent(path)
+        self.markdirty('nginx-sp')
+
+    def purgecache(self, urls=None, prefixes=None):
+        if not self.isvalidapp():
+            raise Exception('A valid app name should be provided.')
+        details = self.appdetails()
+        cachedir = self.appcachedir()
+        if not os.path.isdir(cachedir):
+            return 0
+        domains = details.get('domains')
+        purged = 0
+        if urls:
+            purged += cache.purgekeys(cachedir, [key for url in urls for key in cache.cachekeys(url, domains)])
+        if prefixes:
+            purged += cache.purgeprefixes(cachedir, [key for prefix in prefixes for key in cache.cachekeys(prefix, domains)])
+        if not urls and not prefixes:
+            purged = cache.purgeall(cachedir)
+        return purged
@@ -0,0 +1,151 @@
+import os
+import struct
+import threading
+from .tools import phpversions
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+metamask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE
+treemask = IN_CREATE | IN_DELETE | IN_MOVED_TO | IN_MOVED_FROM | IN_ONLYDIR
+appsmask = IN_CREATE | IN_DELETE | IN_MOVED_TO | IN_MOVED_FROM | IN_ATTRIB | IN_ONLYDIR
+
+eventheader = struct.Struct('iIII')
+
+class Inotify:
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.ctypes = ctypes
+        self.paths = {}
+
+    def watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = self.ctypes.get_errno()
+            raise OSError(errno, '{}: {}'.format(os.strerror(errno), path))
+        self.paths[wd] = path
+        return wd
+
+    def read(self):
+        data = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset + eventheader.size <= len(data):
+            wd, mask, cookie, length = eventheader.unpack_from(data, offset)
+            offset += eventheader.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+                continue
+            events.append((self.paths.get(wd), mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+class Watcher:
+    def __init__(self, sp, interval=5):
+        self.sp = sp
+        self.interval = interval
+        self.etcdir = os.path.join(sp.mainroot, 'etc')
+        self.inotify = None
+        self.appsdirs = set()
+        self.stopped = threading.Event()
+
+    def start(self):
+        try:
+            self.inotify = Inotify()
+            self.watchall()
+            target = self.runinotify
+        except (OSError, AttributeError):
+            # No inotify (or too few watches): rescan on a timer instead.
+            if self.inotify is not None:
+                self.inotify.close()
+                self.inotify = None
+            target = self.runpolling
+        thread = threading.Thread(target=target, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.stopped.set()
+
+    def watchall(self):
+        self.inotify.watch(self.sp.metadir, metamask)
+        self.inotify.watch(self.etcdir, treemask)
+        if os.path.isdir(self.sp.usrdataroot):
+            self.inotify.watch(self.sp.usrdataroot, treemask)
+            with os.scandir(self.sp.usrdataroot) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        self.watchuser(entry.path)
+
+    def watchuser(self, usrhome):
+        self.inotify.watch(usrhome, treemask)
+        appsdir = os.path.join(usrhome, 'apps')
+        if os.path.isdir(appsdir):
+            self.watchapps(appsdir)
+
+    def watchapps(self, appsdir):
+        self.inotify.watch(appsdir, appsmask)
+        self.appsdirs.add(appsdir)
+
+    def refreshall(self):
+        phpversions.cache_clear()
+        self.sp.syncregistry()
+
+    def handle(self, path, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            self.refreshall()
+        elif path is None:
+            return
+        elif path == self.sp.metadir:
+            if name.endswith('.json'):
+                self.sp.refreshmeta(name[:-5])
+        elif path == self.etcdir:
+            if name.startswith('php') and name.endswith('-sp'):
+                phpversions.cache_clear()
+        elif path == self.sp.usrdataroot:
+            if mask & (IN_CREATE | IN_MOVED_TO) and mask & IN_ISDIR:
+                self.watchuser(os.path.join(path, name))
+        elif path in self.appsdirs:
+            self.sp.registry().dropsize(name)
+        elif name == 'apps' and mask & (IN_CREATE | IN_MOVED_TO):
+            self.watchapps(os.path.join(path, name))
+
+    def runinotify(self):
+        while not self.stopped.is_set():
+            try:
+                events = self.inotify.read()
+            except OSError:
+                break
+            for path, mask, name in events:
+                try:
+                    self.handle(path, mask, name)
+                except Exception:
+                    # One bad entry must not stop the watcher; a full resync catches up.
+                    try:
+                        self.refreshall()
+                    except Exception:
+                        pass
+
+    def runpolling(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.refreshall()
+            except Exception:
+                pass